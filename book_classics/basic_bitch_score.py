@@ -2,131 +2,153 @@
 How 'original' your choices are with respect to other choices in the database.
 """
 
-from typing import List, Dict
-from csv import DictReader
-import os
-from log_utils import setup_logging
+from typing import List, Dict, Optional, Tuple
+from argparse import ArgumentParser
+import pickle
+from log_utils import add_profile_argument, profiler, setup_logging
 import logging
 import Levenshtein
+from bk_tree import BKTree
+from dataset import (PicksDataset, get_all_people, get_book_id, get_resolved_book_fname_for_person,  # noqa: F401
+                     load_dataset, read_resolved_books_for_person)
 
 
-def basic_bitch_scores(cohort: List[str], book: Dict[str, List[str]]):
-    raise NotImplementedError()
-
-
-def get_resolved_book_fname_for_person(person):
-    return "data/resolved-picks/{}.csv".format(person.replace(" ", "_"))
-
-
-def read_resolved_books_for_person(person: str):
-    fname = get_resolved_book_fname_for_person(person)
-    with open(fname) as fp:
-        reader = DictReader(fp)
-        lines = [line for line in reader]
-    return lines
-
-
-def get_all_people() -> List[str]:
-    for fname in os.listdir("data/resolved-picks"):
-        name = os.path.splitext(fname)[0].replace("_", " ").title()
-        yield name
-
-
-def get_book_id(book: dict) -> str:
-    return "title={title},author={author},year={year}".format(
-        title=book["title"], author=book["author"], year=book["year"])
-
-
-def get_basic_bitch_score_for_person(person: str, people_to_books_map: Dict[str, List[str]],
-                                     books_to_people_map: Dict[str, List[str]]) -> float:
-    someone_else_selected_count = 0
-    your_count = 0
-    for book_id in people_to_books_map[person]:
-        if len(books_to_people_map[book_id]) > 1:
-            someone_else_selected_count += 1
-        else:
-            logging.debug("Found unique book for %s: %s", person, book_id)
-        your_count += 1
-    assert your_count > 0
-    return (someone_else_selected_count * 1.0) / your_count
-
-
-def get_basic_bitch_scores(all_people: List[str]) -> Dict[str, float]:
-    # map from books to people that chose that book
-    all_books = {}
-    # map from 'book_id' to full information about that book
-    book_map = {}
-    # map from person's name to list of books they selected (book IDs)
-    person_to_books = {}
-    for person in all_people:
-        books = read_resolved_books_for_person(person)
-        person_to_books[person] = []
-        for book in books:
-            book_id = get_book_id(book)
-            all_books.setdefault(book_id, [])
-            all_books[book_id].append(person)
-            book_map[book_id] = book
-            person_to_books[person].append(book_id)
+def get_basic_bitch_scores(dataset: PicksDataset, cohort: Optional[List[str]] = None) -> Dict[str, float]:
     # goal: map of person to basic bitch score
     # basic bitch score = (# books you selected that someone else also selected) / (# books you selected)
-    scores = {}
-    for person in all_people:
-        score = get_basic_bitch_score_for_person(
-            person,
-            person_to_books,
-            all_books
-        )
-        scores[person] = score
-    return scores
+    return dataset.get_incidence().basic_bitch_scores(cohort)
+
+
+# the thresholds used to decide whether two titles are probably the same book
+MAX_TITLE_DISTANCE = 5
+MAX_AUTHOR_DISTANCE = 5
+
+
+def find_similar_title_pairs(all_books: List[dict]) -> Tuple[List[Tuple[int, int, int]], int]:
+    """Find all pairs of books whose titles are close enough to possibly be the same book.
+    Uses a BK-tree so only plausible pairs of titles are compared.
+    :return:    (pairs, num_skipped)
+                pairs is a sorted list of (i, j, title distance) with i < j
+                num_skipped is the net number of title comparisons saved compared to checking every pair,
+                counting those made to build the tree as well as to search it.
+                It is negative when the tree costs more than it saves, as it does for a handful of titles."""
+    tree = BKTree()  # type: BKTree[int]
+    pairs = []
+    for j, book in enumerate(all_books):
+        title = book["title"]
+        for d, other_title, i in tree.search(title, MAX_TITLE_DISTANCE):
+            if d < 0.5 * min(len(title), len(other_title)):
+                pairs.append((i, j, d))
+        tree.add(title, j)
+    pairs.sort()
+    profiler.count("levenshtein.comparisons", tree.num_search_comparisons)
+    profiler.count("levenshtein.bk_tree_insert_comparisons", tree.num_add_comparisons)
+    n = len(all_books)
+    num_skipped = n * (n - 1) // 2 - tree.num_search_comparisons - tree.num_add_comparisons
+    return pairs, num_skipped
 
 
 def check_books_unique(all_books: List[dict]) -> bool:
     """Make sure that the books selected are actually unique and we don't have the same book under multiple names"""
     unique_flag = True
-    all_titles = [book["title"] for book in all_books]
-    for i, book1 in enumerate(all_titles):
-        for j, book2 in enumerate(all_titles[i + 1:]):
-            # get the distance between these books
-            d = Levenshtein.distance(book1, book2)
-            if d <= 5 and d < 0.5 * min(len(book1), len(book2)):
-                # now check the author to see if they are similar or typo
-                b1 = all_books[i]
-                b2 = all_books[i + j + 1]
-                author_d = Levenshtein.distance(b1["author"], b2["author"])
-                if author_d <= 5:
-                    print("Books '{}' and '{}' have Levenshtein distance {}".format(book1, book2, d))
-                    unique_flag = False
-                else:
-                    logging.info("Books '{}' and '{}' have Levenshtein distance {}...".format(book1, book2, d))
-                    logging.info("But they have different authors '{}' and '{}' with distance {}".format(
-                        b1["author"], b2["author"], author_d))
+    pairs, num_skipped = find_similar_title_pairs(all_books)
+    logging.debug("Saved %d title comparisons net while checking %d books for uniqueness",
+                  num_skipped, len(all_books))
+    for i, j, d in pairs:
+        b1 = all_books[i]
+        b2 = all_books[j]
+        book1 = b1["title"]
+        book2 = b2["title"]
+        # now check the author to see if they are similar or typo
+        author_d = Levenshtein.distance(b1["author"], b2["author"])
+        profiler.count("levenshtein.comparisons")
+        if author_d <= MAX_AUTHOR_DISTANCE:
+            print("Books '{}' and '{}' have Levenshtein distance {}".format(book1, book2, d))
+            unique_flag = False
+        else:
+            logging.info("Books '{}' and '{}' have Levenshtein distance {}...".format(book1, book2, d))
+            logging.info("But they have different authors '{}' and '{}' with distance {}".format(
+                b1["author"], b2["author"], author_d))
     return unique_flag
 
 
-def get_all_book_titles(all_people: List[str]) -> List[dict]:
-    all_books = []
-    s = set([])
-    for person in all_people:
-        books = read_resolved_books_for_person(person)
-        book_ids = [get_book_id(book) for book in books]
-        for book_id, book in zip(book_ids, books):
-            if book_id not in s:
-                all_books.append(book)
-                s.add(book_id)
-    return all_books
+class ScoringState:
+    """Persisted scoring state so that a rerun in which no resolved picks changed doesn't rescore anyone.
+    When any did, everyone is rescored from the dataset's incidence matrix, since the scores of people who share
+    a book with whoever changed change too, and scoring everyone is a handful of sparse reductions."""
+    FNAME = "data/scoring-state.dat"
+    VERSION = 4
+
+    def __init__(self) -> None:
+        # map from person to sha1 of their resolved picks file
+        self.digests: Dict[str, str] = {}
+        # map from person to their basic bitch score
+        self.scores: Dict[str, float] = {}
+        self.is_dirty = True
+
+    @staticmethod
+    def load() -> "ScoringState":
+        with open(ScoringState.FNAME, "rb") as fp:
+            state = pickle.load(fp)
+        if not isinstance(state, ScoringState) or getattr(state, "version", None) != ScoringState.VERSION:
+            raise IOError("Scoring state in {} is out of date".format(ScoringState.FNAME))
+        state.is_dirty = False
+        return state
+
+    def save(self) -> None:
+        if self.is_dirty:
+            self.version = ScoringState.VERSION
+            with open(ScoringState.FNAME, "wb") as fp:
+                pickle.dump(self, fp)
+            logging.debug("Saved scoring state to disk")
+            self.is_dirty = False
+
+    def update(self, dataset: PicksDataset) -> List[str]:
+        """Bring the state up to date with the loaded resolved picks
+        :return:    The people whose score changed"""
+        digests = dict(zip(dataset.people, dataset.digests))
+        if digests == self.digests:
+            logging.info("No resolved picks changed, not rescoring")
+            return []
+        changed = [person for person, digest in digests.items() if self.digests.get(person) != digest]
+        removed = set(self.digests) - set(digests)
+        with profiler.span("scoring.incidence"):
+            scores = dataset.get_incidence().basic_bitch_scores()
+        rescored = sorted(person for person, score in scores.items() if self.scores.get(person) != score)
+        self.digests = digests
+        self.scores = scores
+        self.is_dirty = True
+        logging.info("%d people changed, %d removed, %d scores changed",
+                     len(changed), len(removed), len(rescored))
+        return rescored
+
+    def get_scores(self) -> Dict[str, float]:
+        return dict(self.scores)
 
 
 if __name__ == "__main__":
-    setup_logging(verbose=False)
-    # when None it means everyone
-    cohort = None
+    parser = ArgumentParser()
+    parser.add_argument("--full", action="store_true", default=False,
+                        help="Ignore the saved scoring state and rescore everyone from scratch")
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    setup_logging(verbose=False, profile=args.profile)
     all_people = [person for person in get_all_people()]
-    all_books = get_all_book_titles(all_people)
-    are_unique = check_books_unique(all_books)
+    with profiler.span("scoring.load_dataset"):
+        dataset = load_dataset(all_people)
+    with profiler.span("scoring.check_books_unique"):
+        are_unique = check_books_unique(dataset.get_all_books())
     if not are_unique:
         logging.error("Books not unique, stopping computation")
         raise SystemExit()
-    scores = get_basic_bitch_scores(all_people)
+    try:
+        state = ScoringState() if args.full else ScoringState.load()
+    except IOError:
+        state = ScoringState()
+    with profiler.span("scoring.update"):
+        state.update(dataset)
+    scores = state.get_scores()
+    state.save()
     for person in sorted(scores, key=scores.get, reverse=True):
         score = scores[person]
         print("%s -> %.3f" % (person, score))
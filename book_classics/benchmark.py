@@ -0,0 +1,177 @@
+"""
+Benchmarks for the hot paths of the pipeline, run against a synthetic corpus (see synthetic_corpus.py).
+
+Prints (or writes) a JSON report with the wall time and peak memory of each benchmark, e.g.
+
+    python book_classics/benchmark.py --people 10000 --books 100000 --out bench.json
+"""
+
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from typing import Callable, Dict, List
+
+from log_utils import setup_logging
+from synthetic_corpus import get_person_name, write_corpus
+
+BENCHMARKS = [
+    "load_dataset",
+    "check_books_unique",
+    "get_basic_bitch_scores",
+    "suggest_book_from_results",
+    "get_infobox_from_html",
+    "similarity_exact",
+    "similarity_approximate",
+]
+
+
+def measure(fn: Callable[[], object], repeat: int = 1, trace_memory: bool = True) -> dict:
+    """Run fn repeat times, then once more under tracemalloc, which slows it down too much to time
+    :return:        timings in seconds, and the peak memory allocated by Python during a run in bytes"""
+    times = []
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+        peak_bytes = None
+        if trace_memory:
+            tracemalloc.start()
+            fn()
+            peak_bytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    return {
+        "min_seconds": min(times),
+        "mean_seconds": sum(times) / len(times),
+        "repeat": repeat,
+        "peak_bytes": peak_bytes,
+    }
+
+
+def run_benchmarks(corpus_dir: str, num_people: int, names: List[str], repeat: int = 1,
+                   trace_memory: bool = True) -> Dict[str, dict]:
+    """Run the named benchmarks against the corpus in corpus_dir
+    The working directory is changed to corpus_dir, since the pipeline uses paths relative to it"""
+    os.chdir(corpus_dir)
+    all_people = [get_person_name(i) for i in range(num_people)]
+    results = {}
+
+    from dataset import load_dataset
+    dataset = load_dataset(all_people, cache_fname=None)
+    if "load_dataset" in names:
+        results["load_dataset"] = measure(lambda: load_dataset(all_people, cache_fname=None), repeat, trace_memory)
+        results["load_dataset"]["picks"] = len(dataset.person_ids)
+
+    if "check_books_unique" in names:
+        from basic_bitch_score import check_books_unique
+        all_books = dataset.get_all_books()
+        results["check_books_unique"] = measure(lambda: check_books_unique(all_books), repeat, trace_memory)
+        results["check_books_unique"]["books"] = len(all_books)
+
+    if "get_basic_bitch_scores" in names:
+        from basic_bitch_score import get_basic_bitch_scores
+        results["get_basic_bitch_scores"] = measure(lambda: get_basic_bitch_scores(dataset), repeat, trace_memory)
+        results["get_basic_bitch_scores"]["people"] = len(all_people)
+
+    if "suggest_book_from_results" in names:
+        from goodreads import iter_search_candidates, suggest_book_from_results
+        from search_cache import GoodreadsSearchCache
+        search_cache = GoodreadsSearchCache()
+        queries = [row[0] for row in search_cache.conn.execute("SELECT query FROM search_results")]
+        responses = [(query, search_cache.get(query)) for query in queries]
+        search_cache.close()
+
+        def suggest_all() -> None:
+            for query, response in responses:
+                suggest_book_from_results(query, iter_search_candidates(response, query))
+
+        results["suggest_book_from_results"] = measure(suggest_all, repeat, trace_memory)
+        results["suggest_book_from_results"]["responses"] = len(responses)
+
+    if "get_infobox_from_html" in names:
+        from ru_wiki import WIKI_HTML_CACHE_DIR, get_infobox_from_html, read_html
+        articles = [read_html(os.path.join(WIKI_HTML_CACHE_DIR, fname))
+                    for fname in sorted(os.listdir(WIKI_HTML_CACHE_DIR))]
+
+        def parse_all() -> None:
+            for html in articles:
+                get_infobox_from_html(html)
+
+        results["get_infobox_from_html"] = measure(parse_all, repeat, trace_memory)
+        results["get_infobox_from_html"]["articles"] = len(articles)
+
+    if "similarity_exact" in names or "similarity_approximate" in names:
+        from similarity import iter_approximate_neighbours, iter_exact_neighbours
+        incidence = dataset.get_incidence()
+
+        def get_pairs(chunks) -> set:
+            return {pair for chunk in chunks for pair in zip(chunk.people.tolist(), chunk.neighbours.tolist())}
+
+        exact_pairs = get_pairs(iter_exact_neighbours(incidence))
+        if "similarity_exact" in names:
+            results["similarity_exact"] = measure(lambda: list(iter_exact_neighbours(incidence)),
+                                                  repeat, trace_memory)
+            results["similarity_exact"]["neighbours"] = len(exact_pairs)
+        if "similarity_approximate" in names:
+            results["similarity_approximate"] = measure(lambda: list(iter_approximate_neighbours(incidence)),
+                                                        repeat, trace_memory)
+            approximate_pairs = get_pairs(iter_approximate_neighbours(incidence))
+            results["similarity_approximate"]["neighbours"] = len(approximate_pairs)
+            # fraction of the exact top k neighbours which approximate mode found
+            results["similarity_approximate"]["recall"] = \
+                len(exact_pairs & approximate_pairs) / max(len(exact_pairs), 1)
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--people", type=int, default=1000)
+    parser.add_argument("--books", type=int, default=10000)
+    parser.add_argument("--picks-per-person", type=int, default=30)
+    parser.add_argument("--typo-rate", type=float, default=0.05)
+    parser.add_argument("--search-responses", type=int, default=1000)
+    parser.add_argument("--articles", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-memory", action="store_true",
+                        help="Don't measure peak memory, which takes one more run of each benchmark")
+    parser.add_argument("--corpus-dir",
+                        help="Reuse the synthetic corpus in this directory instead of generating a new one")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=BENCHMARKS,
+                        help="Only run these benchmarks")
+    parser.add_argument("-o", "--out", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    setup_logging(verbose=False)
+    out_fname = os.path.abspath(args.out) if args.out else None
+    corpus_dir = args.corpus_dir
+    corpus = None
+    if corpus_dir is None:
+        corpus_dir = tempfile.mkdtemp(prefix="book-classics-bench-")
+        start = time.perf_counter()
+        corpus = write_corpus(corpus_dir, args.people, args.books, picks_per_person=args.picks_per_person,
+                              typo_rate=args.typo_rate, seed=args.seed,
+                              num_search_responses=args.search_responses, num_articles=args.articles)
+        corpus["generate_seconds"] = time.perf_counter() - start
+    # the benchmarked code logs a lot at INFO
+    logging.getLogger().setLevel(logging.WARNING)
+    results = run_benchmarks(corpus_dir, args.people, args.only, repeat=args.repeat,
+                             trace_memory=not args.no_memory)
+    report = {
+        "corpus_dir": corpus_dir,
+        "corpus": corpus,
+        "python": sys.version.split()[0],
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "benchmarks": results,
+    }
+    if out_fname:
+        with open(out_fname, "w") as fp:
+            json.dump(report, fp, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
@@ -0,0 +1,73 @@
+"""
+A BK-tree (Burkhard-Keller tree) over strings.
+
+Lets us find every string within a given edit distance of a query without comparing the query
+against every string in the collection. Relies on the triangle inequality of Levenshtein distance.
+"""
+
+from typing import Callable, Generic, Iterator, Tuple, TypeVar
+
+import Levenshtein
+
+T = TypeVar("T")
+
+
+class BKTreeNode(Generic[T]):
+    __slots__ = ["key", "values", "children"]
+
+    def __init__(self, key: str, value: T) -> None:
+        self.key = key
+        # several values may share the exact same key
+        self.values = [value]  # type: List[T]
+        # map from edit distance to child node
+        self.children = {}  # type: Dict[int, BKTreeNode[T]]
+
+
+class BKTree(Generic[T]):
+    def __init__(self, distance: Callable[[str, str], int] = Levenshtein.distance) -> None:
+        self.distance = distance
+        self.root = None  # type: Optional[BKTreeNode[T]]
+        self.size = 0
+        # number of times the distance function was called by search and by add,
+        # useful to see how much work we saved
+        self.num_search_comparisons = 0
+        self.num_add_comparisons = 0
+
+    def add(self, key: str, value: T) -> None:
+        self.size += 1
+        if self.root is None:
+            self.root = BKTreeNode(key, value)
+            return
+        node = self.root
+        while True:
+            d = self.distance(key, node.key)
+            self.num_add_comparisons += 1
+            if d == 0:
+                node.values.append(value)
+                return
+            child = node.children.get(d)
+            if child is None:
+                node.children[d] = BKTreeNode(key, value)
+                return
+            node = child
+
+    def search(self, query: str, max_distance: int) -> Iterator[Tuple[int, str, T]]:
+        """Yield (distance, key, value) for every stored key within max_distance of the query"""
+        if self.root is None:
+            return
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            d = self.distance(query, node.key)
+            self.num_search_comparisons += 1
+            if d <= max_distance:
+                for value in node.values:
+                    yield d, node.key, value
+            lo = d - max_distance
+            hi = d + max_distance
+            for edge, child in node.children.items():
+                if lo <= edge <= hi:
+                    stack.append(child)
+
+    def __len__(self) -> int:
+        return self.size
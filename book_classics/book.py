@@ -1,4 +1,11 @@
+from typing import Optional
+
+
 class Book:
+    __slots__ = ["title", "author", "original_publication_year", "str_distance"]
+    # bump this whenever the fields in to_dict change
+    SERIALIZATION_VERSION = 1
+
     def __init__(self, title: str, author: str, original_publication_year: int,
                  str_distance: int) -> None:
         self.title = title
@@ -10,12 +17,43 @@ class Book:
         return "{} by {}, published in {}".format(
             self.title, self.author, self.original_publication_year)
 
+    def to_dict(self) -> dict:
+        d = {slot: getattr(self, slot) for cls in type(self).__mro__ for slot in getattr(cls, "__slots__", [])}
+        d["version"] = self.SERIALIZATION_VERSION
+        return d
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "Book":
+        book = cls.__new__(cls)
+        book.__setstate__(d)
+        return book
+
+    def __getstate__(self) -> dict:
+        return self.to_dict()
+
+    def __setstate__(self, state: dict) -> None:
+        state = dict(state)
+        version = state.pop("version", None)
+        if version is None:
+            state = self._upgrade_legacy_state(state)
+        elif version != self.SERIALIZATION_VERSION:
+            raise ValueError("Unknown {} serialization version {}".format(type(self).__name__, version))
+        for key, value in state.items():
+            setattr(self, key, value)
+
+    @staticmethod
+    def _upgrade_legacy_state(state: dict) -> dict:
+        """Books pickled before we used __slots__ have their __dict__ as the state"""
+        return state
+
 
 class GoodreadsBook(Book):
-    def __init__(self, title: str, author: str, original_publication_year,
+    __slots__ = ["num_ratings", "goodreads_id"]
+
+    def __init__(self, title: str, author: str, original_publication_year: Optional[int],
                  str_distance: int,
                  num_ratings: int,
-                 node) -> None:
+                 goodreads_id: int) -> None:
         super().__init__(
             title=title,
             author=author,
@@ -23,7 +61,15 @@ class GoodreadsBook(Book):
             str_distance=str_distance
         )
         self.num_ratings = num_ratings
-        self.node = node
+        self.goodreads_id = goodreads_id
 
     def get_goodreads_id(self) -> int:
-        return int(self.node.find("id").text)
+        return self.goodreads_id
+
+    @staticmethod
+    def _upgrade_legacy_state(state: dict) -> dict:
+        """Old GoodreadsBooks kept the whole ElementTree 'work' node just to read the ID from it"""
+        node = state.pop("node", None)
+        if node is not None:
+            state["goodreads_id"] = int(node.find("id").text)
+        return state
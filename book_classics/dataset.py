@@ -0,0 +1,260 @@
+"""
+Load all the resolved picks in one pass into a compact, dictionary-encoded columnar store.
+
+Every pick is a (person id, book index) row. People and books are kept in separate tables.
+Books are identified by their Goodreads ID (see get_book_id).
+The loaded dataset can be cached to disk as an .npz file, which is invalidated when any resolved picks file changes.
+"""
+
+import hashlib
+import io
+import logging
+import os
+from csv import DictReader
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from incidence import PersonBookIncidence
+
+RESOLVED_PICKS_DIR = "data/resolved-picks"
+DATASET_CACHE_FNAME = "data/resolved-picks-cache.npz"
+
+
+def get_resolved_book_fname_for_person(person):
+    return "{dir}/{person}.csv".format(dir=RESOLVED_PICKS_DIR, person=person.replace(" ", "_"))
+
+
+def read_resolved_books_for_person(person: str):
+    fname = get_resolved_book_fname_for_person(person)
+    with open(fname) as fp:
+        reader = DictReader(fp)
+        lines = [line for line in reader]
+    return lines
+
+
+def get_all_people() -> Iterator[str]:
+    for fname in os.listdir(RESOLVED_PICKS_DIR):
+        # skip the partial files and checkpoints of interrupted resolutions
+        if not fname.endswith(".csv"):
+            continue
+        name = os.path.splitext(fname)[0].replace("_", " ").title()
+        yield name
+
+
+# map from legacy book key to the interned book ID for that key
+_legacy_book_ids: Dict[str, int] = {}
+
+
+def get_legacy_book_key(book: dict) -> str:
+    return "title={title},author={author},year={year}".format(
+        title=book["title"], author=book["author"], year=book["year"])
+
+
+def intern_legacy_book(book: dict) -> int:
+    """Rows resolved before we saved the Goodreads ID don't have one.
+    Give them a negative ID derived from title, author and year, so that it never collides with a Goodreads ID
+    and is the same across runs."""
+    key = get_legacy_book_key(book)
+    book_id = _legacy_book_ids.get(key)
+    if book_id is None:
+        book_id = -1 - int(hashlib.sha1(key.encode("utf-8")).hexdigest()[:15], 16)
+        _legacy_book_ids[key] = book_id
+    return book_id
+
+
+def get_book_id(book: dict, legacy_goodreads_ids: Optional[Dict[str, int]] = None) -> int:
+    """
+    :param legacy_goodreads_ids:    map from legacy book key to the Goodreads ID of the same book in a newer file,
+                                    so that a book resolved both before and after we saved the ID has a single ID
+    :return:                        The Goodreads ID of the book if we have it, otherwise an interned legacy ID
+    """
+    goodreads_id = book.get("goodreads_id")
+    if goodreads_id:
+        return int(goodreads_id)
+    if legacy_goodreads_ids is not None:
+        goodreads_id = legacy_goodreads_ids.get(get_legacy_book_key(book))
+        if goodreads_id is not None:
+            return goodreads_id
+    return intern_legacy_book(book)
+
+
+def get_file_stat(fname: str) -> Tuple[float, int]:
+    """:return: (mtime, size)"""
+    st = os.stat(fname)
+    return (st.st_mtime, st.st_size)
+
+
+class PicksDataset:
+    def __init__(self, people: List[str], person_ids: np.ndarray, book_ids: np.ndarray,
+                 keys: np.ndarray, titles: List[str], authors: List[str], years: List[str],
+                 file_stats: List[Tuple[float, int]], digests: List[str]) -> None:
+        """
+        :param people:          Table of people, indexed by person id
+        :param person_ids:      Person id of each pick
+        :param book_ids:        Book index of each pick
+        :param keys:            Table of book IDs (see get_book_id), indexed by book index
+        :param titles:          Table of book titles, indexed by book index
+        :param authors:         Table of book authors, indexed by book index
+        :param years:           Table of book years, indexed by book index
+        :param file_stats:      (mtime, size) of each person's resolved picks file when it was read
+        :param digests:         sha1 of each person's resolved picks file
+        """
+        assert len(person_ids) == len(book_ids)
+        assert len(keys) == len(titles) == len(authors) == len(years)
+        assert len(people) == len(file_stats) == len(digests)
+        self.people = people
+        self.person_ids = person_ids
+        self.book_ids = book_ids
+        self.keys = keys
+        self.titles = titles
+        self.authors = authors
+        self.years = years
+        self.file_stats = file_stats
+        self.digests = digests
+
+    @property
+    def num_books(self) -> int:
+        return len(self.titles)
+
+    def get_book(self, book_index: int) -> dict:
+        return {
+            "title": self.titles[book_index],
+            "author": self.authors[book_index],
+            "year": self.years[book_index],
+        }
+
+    def get_all_books(self) -> List[dict]:
+        return [self.get_book(book_index) for book_index in range(self.num_books)]
+
+    def get_incidence(self) -> PersonBookIncidence:
+        # scipy is slow to import, and incremental scoring never builds a matrix
+        from scipy import sparse
+        data = np.ones(len(self.person_ids), dtype=np.int32)
+        matrix = sparse.coo_matrix(
+            (data, (self.person_ids, self.book_ids)),
+            shape=(len(self.people), self.num_books)
+        ).tocsr()
+        return PersonBookIncidence(list(self.people), self.keys.tolist(), matrix)
+
+    def save(self, fname: str) -> None:
+        # write to a temp file then move so readers never see a partial cache
+        tmp_fname = fname + ".tmp.npz"
+        np.savez_compressed(
+            tmp_fname,
+            people=np.array(self.people, dtype=str),
+            person_ids=self.person_ids,
+            book_ids=self.book_ids,
+            keys=self.keys,
+            titles=np.array(self.titles, dtype=str),
+            authors=np.array(self.authors, dtype=str),
+            years=np.array(self.years, dtype=str),
+            mtimes=np.array([stat[0] for stat in self.file_stats], dtype=np.float64),
+            sizes=np.array([stat[1] for stat in self.file_stats], dtype=np.int64),
+            digests=np.array(self.digests, dtype=str),
+        )
+        os.replace(tmp_fname, fname)
+        logging.debug("Saved resolved picks dataset to %s", fname)
+
+    @staticmethod
+    def load(fname: str) -> "PicksDataset":
+        with np.load(fname, allow_pickle=False) as data:
+            return PicksDataset(
+                people=data["people"].tolist(),
+                person_ids=data["person_ids"],
+                book_ids=data["book_ids"],
+                keys=data["keys"],
+                titles=data["titles"].tolist(),
+                authors=data["authors"].tolist(),
+                years=data["years"].tolist(),
+                file_stats=list(zip(data["mtimes"].tolist(), data["sizes"].tolist())),
+                digests=data["digests"].tolist(),
+            )
+
+    def is_up_to_date(self, all_people: List[str]) -> bool:
+        if self.people != list(all_people):
+            return False
+        for person, file_stat in zip(self.people, self.file_stats):
+            try:
+                if get_file_stat(get_resolved_book_fname_for_person(person)) != tuple(file_stat):
+                    return False
+            except OSError:
+                return False
+        return True
+
+
+def read_dataset(all_people: List[str]) -> PicksDataset:
+    """Parse all the resolved picks files. Each file is read once,
+    but the rows are only interned after all of them are read, since a legacy row takes the Goodreads ID
+    of the same book in any other file (see get_book_id)."""
+    # map from book ID to book index
+    book_index: Dict[int, int] = {}
+    keys = []
+    titles = []
+    authors = []
+    years = []
+    person_ids = []
+    book_ids = []
+    file_stats = []
+    digests = []
+    rows = []
+    legacy_goodreads_ids: Dict[str, int] = {}
+    for person in all_people:
+        fname = get_resolved_book_fname_for_person(person)
+        file_stats.append(get_file_stat(fname))
+        with open(fname, "rb") as fp:
+            contents = fp.read()
+        digests.append(hashlib.sha1(contents).hexdigest())
+        person_rows = list(DictReader(io.StringIO(contents.decode("utf-8"))))
+        for book in person_rows:
+            if book.get("goodreads_id"):
+                legacy_goodreads_ids[get_legacy_book_key(book)] = int(book["goodreads_id"])
+        rows.append(person_rows)
+    for person_id, person_rows in enumerate(rows):
+        for book in person_rows:
+            key = get_book_id(book, legacy_goodreads_ids)
+            book_id = book_index.get(key)
+            if book_id is None:
+                book_id = len(book_index)
+                book_index[key] = book_id
+                keys.append(key)
+                titles.append(book["title"])
+                authors.append(book["author"])
+                years.append(book["year"])
+            person_ids.append(person_id)
+            book_ids.append(book_id)
+    return PicksDataset(
+        people=list(all_people),
+        person_ids=np.array(person_ids, dtype=np.int32),
+        book_ids=np.array(book_ids, dtype=np.int32),
+        keys=np.array(keys, dtype=np.int64),
+        titles=titles,
+        authors=authors,
+        years=years,
+        file_stats=file_stats,
+        digests=digests,
+    )
+
+
+def load_dataset(all_people: Optional[List[str]] = None,
+                 cache_fname: Optional[str] = DATASET_CACHE_FNAME) -> PicksDataset:
+    """
+    Load the resolved picks for the given people
+    :param all_people:      When None it means everyone
+    :param cache_fname:     Where to cache the parsed dataset. When None, don't cache.
+    """
+    if all_people is None:
+        all_people = sorted(get_all_people())
+    if cache_fname is not None and os.path.exists(cache_fname):
+        try:
+            dataset = PicksDataset.load(cache_fname)
+            if dataset.is_up_to_date(all_people):
+                logging.debug("Loaded resolved picks dataset from cache %s", cache_fname)
+                return dataset
+            logging.debug("Resolved picks dataset cache is out of date")
+        except (OSError, ValueError, KeyError):
+            logging.warning("Failed to read resolved picks dataset cache %s", cache_fname)
+    dataset = read_dataset(all_people)
+    if cache_fname is not None:
+        dataset.save(cache_fname)
+    return dataset
@@ -1,96 +1,415 @@
 from __future__ import print_function
 
 import csv
+import hashlib
+import io
+import json
 import logging
 import os
 import pickle
-import xml.etree.ElementTree as ET
+import random
+import re
+import sqlite3
+import threading
+import time
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
 # from pprint import pprint
 
-import requests
 from Levenshtein import distance
-from typing import Iterator, List, Optional
+from typing import TYPE_CHECKING, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
+from bk_tree import BKTree
 from book import GoodreadsBook
-from goodreads_secrets import key
-from log_utils import setup_logging
+from log_utils import add_profile_argument, profiler, setup_logging
+from review_queue import ReviewQueue
+from search_cache import GoodreadsSearchCache, SearchCandidate, normalize_query
+
+if TYPE_CHECKING:
+    # requests and the XML parser are only imported once we actually go to the network or parse a response,
+    # so a run which is answered entirely from the caches starts quickly
+    import requests
 
 
-GOODREADS_CACHE_DIR = "data/goodreads-cache"
 RESOLVED_PICKS_DIR = "data/resolved-picks"
 
 
-def search_for_book(title: str) -> ET.Element:
+# point this at a local stand-in (see replay_server.py) to run without the real API
+GOODREADS_BASE_URL = os.environ.get("GOODREADS_BASE_URL", "https://www.goodreads.com")
+GOODREADS_SEARCH_URL = GOODREADS_BASE_URL.rstrip("/") + "/search/index.xml"
+# the Goodreads API terms allow at most one request per second
+DEFAULT_REQUESTS_PER_SECOND = 1.0
+DEFAULT_PREFETCH_JOBS = 4
+# search results which are too far from the query, or have too few ratings, are never considered
+MAX_STR_DISTANCE = 50
+MIN_NUM_RATINGS = 100
+# queries within this edit distance of a resolved query or title are answered from the resolution cache.
+# -1 only answers exact queries from the cache.
+DEFAULT_MAX_FUZZY_DISTANCE = 2
+# and a fuzzy match may have at most one edit per this many characters of the query, so short titles must match exactly
+FUZZY_CHARS_PER_EDIT = 5
+# a number or roman numeral, which usually tells apart the volumes of a series, e.g. "foundation 2" or "part ii"
+VOLUME_NUMBER_RE = re.compile(r"^(\d+|m{0,3}(cm|cd|d?c{0,3})(xc|xl|l?x{0,3})(ix|iv|v?i{0,3}))$")
+# cached search responses older than this are still used, but refetched in the background
+# so that the numbers of ratings get_obviously_correct_book relies on don't drift too far
+DEFAULT_CACHE_TTL_DAYS = 30.0
+# how many times a request which failed with a 429, a 5xx or a connection error is retried
+MAX_RETRIES = 5
+# the wait before retry n is a random fraction of BACKOFF_BASE_SECONDS * 2 ** n, up to MAX_BACKOFF_SECONDS
+BACKOFF_BASE_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 60.0
+REQUEST_TIMEOUT_SECONDS = 30
+
+
+_search_cache: Optional[GoodreadsSearchCache] = None
+_session: Optional["requests.Session"] = None
+_session_pool_size = 0
+_api_key: Optional[str] = None
+# in seconds, None to never revalidate
+_cache_ttl: Optional[float] = DEFAULT_CACHE_TTL_DAYS * 24 * 60 * 60
+# background revalidation of stale search responses, one request at a time
+_revalidation_executor: Optional[ThreadPoolExecutor] = None
+# normalized queries which are being revalidated
+_revalidating: Set[str] = set([])
+_revalidating_lock = threading.Lock()
+
+
+def get_search_cache() -> GoodreadsSearchCache:
+    global _search_cache
+    if _search_cache is None:
+        _search_cache = GoodreadsSearchCache()
+    return _search_cache
+
+
+def get_session(pool_size: int = DEFAULT_PREFETCH_JOBS) -> "requests.Session":
+    """One pooled session shared by every request to Goodreads, so connections are reused
+    :param pool_size:       Number of connections to keep open, at least the number of threads making requests.
+                            The pool is only ever grown."""
+    global _session, _session_pool_size
+    if _session is None or pool_size > _session_pool_size:
+        import requests
+        from requests.adapters import HTTPAdapter
+        if _session is None:
+            _session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=pool_size)
+        _session.mount("https://", adapter)
+        _session.mount("http://", adapter)
+        _session_pool_size = pool_size
+    return _session
+
+
+def get_api_key() -> str:
+    """The Goodreads API key is read from the GOODREADS_API_KEY environment variable,
+    or failing that from goodreads_secrets.py, only when a request is actually made"""
+    global _api_key
+    if _api_key is None:
+        _api_key = os.environ.get("GOODREADS_API_KEY")
+    if _api_key is None:
+        try:
+            from goodreads_secrets import key
+        except ImportError:
+            raise GoodreadsResolutionException(
+                "No Goodreads API key. Set GOODREADS_API_KEY or add goodreads_secrets.py with a 'key' variable.")
+        _api_key = key
+    return _api_key
+
+
+class RateLimiter:
+    """Thread-safe limiter which spaces out calls to wait() to at most requests_per_second"""
+
+    def __init__(self, requests_per_second: float) -> None:
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+        self.set_rate(requests_per_second)
+
+    def set_rate(self, requests_per_second: float) -> None:
+        assert requests_per_second > 0
+        with self.lock:
+            self.interval = 1.0 / requests_per_second
+
+    def wait(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+# every request to Goodreads in this process goes through this, whether it is a prefetch,
+# a foreground search or a background revalidation
+_rate_limiter = RateLimiter(DEFAULT_REQUESTS_PER_SECOND)
+
+
+def set_requests_per_second(requests_per_second: float) -> None:
+    """Set the rate of requests to Goodreads from this process.
+    When several processes resolve at once, each should get its share of the overall rate."""
+    _rate_limiter.set_rate(requests_per_second)
+
+
+def set_cache_ttl(days: Optional[float]) -> None:
+    """:param days:     None or negative to never revalidate cached search responses"""
+    global _cache_ttl
+    _cache_ttl = days * 24 * 60 * 60 if days is not None and days >= 0 else None
+
+
+def get_cache_ttl_days() -> float:
+    """:return:     -1 if cached search responses are never revalidated"""
+    return _cache_ttl / (24 * 60 * 60) if _cache_ttl is not None else -1
+
+
+def get_backoff(attempt: int, retry_after: Optional[str] = None) -> float:
+    """How long to wait before retrying, with full jitter so that concurrent resolvers don't retry in lockstep
+    :param retry_after:     The Retry-After header, which is a minimum"""
+    backoff = random.uniform(0, min(MAX_BACKOFF_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+    if retry_after is not None and retry_after.isdigit():
+        backoff = max(backoff, float(retry_after))
+    return backoff
+
+
+def fetch_search_results(title: str, etag: Optional[str] = None) -> "requests.Response":
+    """Query the Goodreads search API, retrying with exponential backoff on rate limiting and server errors
+    Every attempt waits its turn with the process-wide rate limiter, see set_requests_per_second
+    :param etag:    If set, ask for the response only if it has changed since the one with this ETag
+    :return:        The response, whose status is 200, or 304 if etag was given and nothing has changed"""
+    import requests
+    headers = {"If-None-Match": etag} if etag else {}
+    for attempt in range(MAX_RETRIES + 1):
+        _rate_limiter.wait()
+        try:
+            with profiler.span("http.goodreads.search"):
+                r = get_session().get(GOODREADS_SEARCH_URL, data={
+                    "key": get_api_key(),
+                    "search": "title",
+                    "page": "1",
+                    "q": title
+                }, headers=headers, timeout=REQUEST_TIMEOUT_SECONDS)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == MAX_RETRIES:
+                raise GoodreadsFetchException("Failed to search for '{}': {}".format(title, e))
+            backoff = get_backoff(attempt)
+            logging.warning("Failed to search for '%s' (%s), retrying in %.1fs", title, e, backoff)
+        else:
+            profiler.count("http.goodreads.status.{}".format(r.status_code))
+            if r.status_code == 200 or (r.status_code == 304 and etag):
+                return r
+            if r.status_code != 429 and r.status_code < 500:
+                raise GoodreadsFetchException("Searching for '{}' failed with status {}".format(title, r.status_code))
+            if attempt == MAX_RETRIES:
+                raise GoodreadsFetchException("Searching for '{}' still failed with status {} after {} retries".format(
+                    title, r.status_code, MAX_RETRIES))
+            backoff = get_backoff(attempt, r.headers.get("Retry-After"))
+            logging.warning("Searching for '%s' failed with status %d, retrying in %.1fs",
+                            title, r.status_code, backoff)
+        profiler.count("http.goodreads.retry")
+        time.sleep(backoff)
+    raise AssertionError("unreachable")
+
+
+def is_stale(fetched_at: float) -> bool:
+    return _cache_ttl is not None and time.time() - fetched_at > _cache_ttl
+
+
+def revalidate_search_response(title: str, cache_fname: str) -> None:
+    """Refetch a cached search response, on a background thread
+    Uses its own connection to the search cache, since SQLite connections can't be shared between threads"""
+    search_cache = GoodreadsSearchCache(cache_fname)
+    try:
+        r = fetch_search_results(title, etag=search_cache.get_etag(title))
+        if r.status_code == 304:
+            search_cache.touch(title)
+            profiler.count("search_cache.not_modified")
+        else:
+            search_cache.put(title, r.text, etag=r.headers.get("ETag"))
+            profiler.count("search_cache.revalidated")
+        logging.debug("Revalidated the Goodreads search response for '%s'", title)
+    except Exception:
+        # the stale response will do until next time
+        logging.exception("Failed to revalidate the Goodreads search response for '%s'", title)
+    finally:
+        search_cache.close()
+        with _revalidating_lock:
+            _revalidating.discard(normalize_query(title))
+
+
+def revalidate_if_stale(title: str, search_cache: GoodreadsSearchCache) -> None:
+    """If the cached response to the query is older than the TTL, refetch it in the background"""
+    global _revalidation_executor
+    fetched_at = search_cache.get_fetched_at(title)
+    if fetched_at is None or not is_stale(fetched_at):
+        return
+    with _revalidating_lock:
+        normalized_query = normalize_query(title)
+        if normalized_query in _revalidating:
+            return
+        _revalidating.add(normalized_query)
+        if _revalidation_executor is None:
+            _revalidation_executor = ThreadPoolExecutor(max_workers=1)
+    profiler.count("search_cache.stale")
+    logging.debug("Goodreads search response for '%s' is stale, revalidating in the background", title)
+    _revalidation_executor.submit(revalidate_search_response, title, search_cache.fname)
+
+
+def wait_for_revalidation() -> None:
+    """Wait for all the stale search responses which are being refetched"""
+    global _revalidation_executor
+    if _revalidation_executor is not None:
+        with _revalidating_lock:
+            num_revalidating = len(_revalidating)
+        if num_revalidating > 0:
+            logging.info("Waiting for %d stale Goodreads search responses to be refetched...", num_revalidating)
+        _revalidation_executor.shutdown(wait=True)
+        _revalidation_executor = None
+
+
+def get_search_response(title: str) -> str:
     """
     Search for the book with the given title on goodreads
-    Write the output to the directory GOODREADS_CACHE_DIR
-    :return ET.Element"""
-    if not os.path.exists(GOODREADS_CACHE_DIR):
-        os.makedirs(GOODREADS_CACHE_DIR)
-    goodreads_cache_fname = os.path.join(
-        GOODREADS_CACHE_DIR,
-        "{}.xml".format(title.lower().replace(" ", "_"))
-    )
+    Write the output to the Goodreads search cache
+    A stale cached response is returned straight away, and refetched in the background.
+    :return:        The raw XML response"""
+    search_cache = get_search_cache()
     # check the cache
-    if os.path.exists(goodreads_cache_fname):
+    contents = search_cache.get(title)
+    if contents is not None:
         logging.debug("Hit the Goodreads API XML cache")
-        with open(goodreads_cache_fname) as fp:
-            contents = fp.read()
-            return ET.fromstring(contents)
+        profiler.count("search_cache.xml.hit")
+        revalidate_if_stale(title, search_cache)
+        return contents
     else:
         logging.debug("Cache miss, hitting the goodreads API")
-        r = requests.get("https://www.goodreads.com/search/index.xml", data={
-            "key": key,
-            "search": "title",
-            "page": "1",
-            "q": title
-        })
-        assert r.status_code == 200
-        response = r.text
-        root = ET.fromstring(response)
+        profiler.count("search_cache.xml.miss")
+        r = fetch_search_results(title)
         # write the data
-        tree = ET.ElementTree(root)
-        try:
-            tree.write(goodreads_cache_fname)
-            return root
-        except Exception as e:
-            print(response)
-            print(tree)
-            raise e
+        search_cache.put(title, r.text, etag=r.headers.get("ETag"))
+        return r.text
 
 
-def suggest_book_from_results(searched_title: str, root) -> List[GoodreadsBook]:
+def search_for_book(title: str) -> List[SearchCandidate]:
+    """
+    Search for the book with the given title on goodreads
+    The parsed candidates are cached too, so a cache hit doesn't touch the XML at all
+    :return:        Candidates with enough ratings to be worth considering"""
+    search_cache = get_search_cache()
+    candidates = search_cache.get_candidates(title)
+    if candidates is not None:
+        logging.debug("Hit the Goodreads search candidates cache")
+        profiler.count("search_cache.candidates.hit")
+        revalidate_if_stale(title, search_cache)
+        return candidates
+    profiler.count("search_cache.candidates.miss")
+    response = get_search_response(title)
+    with profiler.span("parse.goodreads_xml"):
+        candidates = list(iter_search_candidates(response, title))
+    search_cache.put_candidates(title, candidates)
+    return candidates
+
+
+def iter_search_candidates(response: str, searched_title: Optional[str] = None) -> Iterator[SearchCandidate]:
     """
-    :param recommendation:          ET.Element
+    Stream the candidates out of a Goodreads search response, without building the whole tree.
+    Each 'work' element is thrown away as soon as it has been read.
+    Candidates with MIN_NUM_RATINGS or fewer ratings are skipped,
+    and so are those whose title is MAX_STR_DISTANCE or more from searched_title, if it is given.
+    """
+    import xml.etree.ElementTree as ET
+    if searched_title is not None:
+        searched_title = searched_title.lower()
+    num_comparisons = 0
+    results = None
+    for event, elem in ET.iterparse(io.BytesIO(response.encode("utf-8")), events=("start", "end")):
+        if event == "start":
+            if elem.tag == "results":
+                results = elem
+            continue
+        if elem.tag != "work":
+            continue
+        num_ratings = int(elem.findtext("ratings_count"))
+        title = elem.findtext("best_book/title")
+        is_relevant = num_ratings > MIN_NUM_RATINGS
+        if is_relevant and searched_title is not None:
+            is_relevant = distance(searched_title, title.lower()) < MAX_STR_DISTANCE
+            num_comparisons += 1
+        if is_relevant:
+            try:
+                pub_year = int(elem.findtext("original_publication_year"))
+            except (TypeError, ValueError):
+                # this happens because source element might be null
+                pub_year = None
+            yield SearchCandidate(
+                goodreads_id=int(elem.findtext("id")),
+                title=title,
+                author=elem.findtext("best_book/author/name"),
+                num_ratings=num_ratings,
+                original_publication_year=pub_year,
+            )
+        if results is not None:
+            results.remove(elem)
+        else:
+            elem.clear()
+    profiler.count("levenshtein.comparisons", num_comparisons)
+
+
+def prefetch_books(queries: List[str], jobs: int = DEFAULT_PREFETCH_JOBS) -> int:
+    """Concurrently fetch every query which isn't in the Goodreads search cache yet,
+    so that resolving those queries afterwards only ever hits the cache
+    The fetches share the process-wide rate limit, see set_requests_per_second
+    :return:        The number of queries fetched"""
+    search_cache = get_search_cache()
+    misses = []
+    seen = set([])
+    for query in queries:
+        normalized_query = normalize_query(query)
+        if normalized_query in seen:
+            continue
+        seen.add(normalized_query)
+        if query not in search_cache:
+            misses.append(query)
+    if misses == []:
+        return 0
+    logging.info("Prefetching %d uncached queries from Goodreads using %d threads...", len(misses), jobs)
+    # one more connection for the background revalidation
+    get_session(jobs + 1)
+    num_fetched = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(fetch_search_results, query): query for query in misses}
+        for future in as_completed(futures):
+            query = futures[future]
+            try:
+                r = future.result()
+            except Exception:
+                # we will try again when resolving this query
+                logging.exception("Failed to prefetch '%s'", query)
+                continue
+            # only this thread writes to the cache
+            search_cache.put(query, r.text, etag=r.headers.get("ETag"))
+            num_fetched += 1
+    logging.info("Prefetched %d queries", num_fetched)
+    return num_fetched
+
+
+def suggest_book_from_results(searched_title: str, candidates: Iterable[SearchCandidate]) -> List[GoodreadsBook]:
+    """
+    :param candidates:          See iter_search_candidates
     """
     relevant_books = []
-    for work_elem in root.find("search").find("results").findall("work"):
-        # parse the element to find info
-        result_title = work_elem.find("best_book").find("title").text
-        author = work_elem.find("best_book").find("author").find("name").text
-        num_ratings = int(work_elem.find("ratings_count").text)
-        try:
-            pub_year = int(work_elem.find("original_publication_year").text)
-        except TypeError:
-            # this happens because source element might be null
-            pub_year = None
-        str_distance = distance(searched_title.lower(), result_title.lower())
+    searched_title = searched_title.lower()
+    num_comparisons = 0
+    for candidate in candidates:
+        str_distance = distance(searched_title, candidate.title.lower())
+        num_comparisons += 1
         # heuristic
-        if str_distance < 50 and num_ratings > 100:
-            # print(ET.dump(work_elem))
+        if str_distance < MAX_STR_DISTANCE and candidate.num_ratings > MIN_NUM_RATINGS:
             relevant_books.append(GoodreadsBook(
-                title=result_title,
-                author=author,
-                num_ratings=num_ratings,
-                original_publication_year=pub_year,
+                title=candidate.title,
+                author=candidate.author,
+                num_ratings=candidate.num_ratings,
+                original_publication_year=candidate.original_publication_year,
                 str_distance=str_distance,
-                node=work_elem,
+                goodreads_id=candidate.goodreads_id,
             ))
-        else:
-            # logging.debug("Skipping title")
-            continue
 
+    profiler.count("levenshtein.comparisons", num_comparisons)
     logging.debug("Before filtering step, found {} relevant results".format(
         len(relevant_books)))
     # filter out those that don't have that many ratings compared to leading candidates
@@ -159,20 +478,135 @@ def resolve_via_human(query: str, relevant_books: List[GoodreadsBook]) -> Goodre
     return relevant_books[int(answer) - 1]
 
 
+RESOLVED_PICKS_HEADER = ["title", "author", "year", "goodreads_id"]
+
+
+def get_resolved_picks_row(book: GoodreadsBook) -> list:
+    return [
+        book.title,
+        book.author,
+        book.original_publication_year,
+        book.get_goodreads_id()
+    ]
+
+
 def save_chosen_books(person: str, chosen_books: List[GoodreadsBook]) -> None:
     fname = get_output_fname(person)
-    with open(fname, "w") as fp:
+    # write to a temp file then move so readers never see a partial file
+    tmp_fname = fname + ".tmp"
+    with open(tmp_fname, "w") as fp:
         writer = csv.writer(fp, quotechar='"', delimiter=',')
-        writer.writerow(["title", "author", "year"])
+        writer.writerow(RESOLVED_PICKS_HEADER)
         for book in chosen_books:
-            writer.writerow([
-                book.title,
-                book.author,
-                book.original_publication_year
-            ])
+            writer.writerow(get_resolved_picks_row(book))
+    os.replace(tmp_fname, fname)
+    # any half-finished resolution of this person is now out of date
+    ResolvedPicksWriter(person).discard()
     logging.info("Saved choices in %s", fname)
 
 
+class ResolvedPicksWriter:
+    """
+    Streams a person's resolved picks to disk as each query is decided, so an interrupted resolution can resume.
+
+    Rows go to $fname.partial, and $fname.checkpoint records how many queries have been decided and how many rows
+    that made, along with the digest of the raw picks file. Once every query is decided, the partial file becomes
+    the resolved picks file, so that file is never incomplete.
+    """
+
+    def __init__(self, person: str, book_file: Optional[str] = None) -> None:
+        """
+        :param book_file:       The person's raw picks file. A checkpoint of a different version of it is ignored.
+        """
+        self.fname = get_output_fname(person)
+        self.partial_fname = self.fname + ".partial"
+        self.checkpoint_fname = self.fname + ".checkpoint"
+        self.book_file_digest = None
+        if book_file is not None:
+            with open(book_file, "rb") as fp:
+                self.book_file_digest = hashlib.sha1(fp.read()).hexdigest()
+        self.num_queries = 0
+        self.num_rows = 0
+        self.fp: Optional[io.TextIOWrapper] = None
+        self.writer = None
+
+    def has_checkpoint(self) -> bool:
+        """:return:     True iff there is a checkpoint which open() would resume from"""
+        return self._read_checkpoint() is not None
+
+    def _read_checkpoint(self) -> Optional[dict]:
+        try:
+            with open(self.checkpoint_fname) as fp:
+                checkpoint = json.load(fp)
+        except (IOError, ValueError):
+            return None
+        if checkpoint.get("book_file_digest") != self.book_file_digest or not os.path.exists(self.partial_fname):
+            return None
+        return checkpoint
+
+    def _write_checkpoint(self) -> None:
+        tmp_fname = self.checkpoint_fname + ".tmp"
+        with open(tmp_fname, "w") as fp:
+            json.dump({
+                "book_file_digest": self.book_file_digest,
+                "num_queries": self.num_queries,
+                "num_rows": self.num_rows,
+            }, fp)
+        os.replace(tmp_fname, self.checkpoint_fname)
+
+    def open(self) -> int:
+        """Start writing, resuming from the checkpoint if there is a usable one
+        :return:        The number of queries which were already decided"""
+        checkpoint = self._read_checkpoint()
+        rows = []
+        if checkpoint is not None:
+            with open(self.partial_fname) as fp:
+                reader = csv.reader(fp, quotechar='"', delimiter=',')
+                next(reader)
+                # rows written after the last checkpoint belong to a query which will be decided again
+                rows = [row for _, row in zip(range(checkpoint["num_rows"]), reader)]
+            self.num_queries = checkpoint["num_queries"]
+        self.num_rows = len(rows)
+        self.fp = open(self.partial_fname, "w")
+        self.writer = csv.writer(self.fp, quotechar='"', delimiter=',')
+        self.writer.writerow(RESOLVED_PICKS_HEADER)
+        self.writer.writerows(rows)
+        self.fp.flush()
+        self._write_checkpoint()
+        return self.num_queries
+
+    def add(self, book: Optional[GoodreadsBook]) -> None:
+        """Record the decision for the next query
+        :param book:        None if the query was skipped or queued for review"""
+        assert self.writer is not None and self.fp is not None
+        if book is not None:
+            self.writer.writerow(get_resolved_picks_row(book))
+            self.num_rows += 1
+            self.fp.flush()
+        self.num_queries += 1
+        self._write_checkpoint()
+
+    def close(self) -> None:
+        """Stop writing, keeping the checkpoint"""
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+            self.writer = None
+
+    def finish(self) -> None:
+        """Every query has been decided"""
+        self.close()
+        os.replace(self.partial_fname, self.fname)
+        os.remove(self.checkpoint_fname)
+        logging.info("Saved choices in %s", self.fname)
+
+    def discard(self) -> None:
+        self.close()
+        for fname in [self.partial_fname, self.checkpoint_fname]:
+            if os.path.exists(fname):
+                os.remove(fname)
+
+
 def get_output_fname(person: str) -> str:
     if not os.path.exists(RESOLVED_PICKS_DIR):
         os.makedirs(RESOLVED_PICKS_DIR)
@@ -191,43 +625,180 @@ def confirm(msg: str) -> bool:
     return user_in == "y"
 
 
-class GoodreadsResolutionCache:
-    FNAME = "data/goodreads-resolution-cache.dat"
+def serialize_book(book: GoodreadsBook) -> str:
+    return json.dumps(book.to_dict())
+
+
+def deserialize_book(s: str) -> GoodreadsBook:
+    return GoodreadsBook.from_dict(json.loads(s))
+
+
+def get_volume_numbers(normalized_query: str) -> List[str]:
+    """The numbers and roman numerals in the query, in order"""
+    return [word for word in re.findall(r"\w+", normalized_query) if VOLUME_NUMBER_RE.match(word)]
+
+
+def get_fuzzy_keys(search_str: str, book: GoodreadsBook) -> List[str]:
+    """The strings a query close to which is probably asking for this book:
+    the query it was resolved from, its title, and its title with the author's last name"""
+    title = normalize_query(book.title)
+    keys = [normalize_query(search_str), title]
+    if book.author:
+        keys.append("{} {}".format(title, normalize_query(book.author.split()[-1])))
+    return keys
+
+
+class FuzzyResolutionIndex:
+    """BK-tree over the fuzzy keys of every resolution in a resolution cache (see get_fuzzy_keys).
+    Resolutions saved since the last update, by this process or another, are added to the tree
+    in order of their rowid, so the tree is only ever built once."""
+
+    def __init__(self) -> None:
+        self.tree: BKTree[Tuple[str, int]] = BKTree()
+        self.last_rowid = 0
+
+    def update(self, conn: sqlite3.Connection) -> None:
+        num_keys = len(self.tree)
+        for rowid, search_str, goodreads_id, book in conn.execute(
+                "SELECT rowid, search_str, goodreads_id, book FROM resolutions WHERE rowid > ? ORDER BY rowid",
+                (self.last_rowid,)):
+            for key in set(get_fuzzy_keys(search_str, deserialize_book(book))):
+                self.tree.add(key, (search_str, goodreads_id))
+            self.last_rowid = rowid
+        if len(self.tree) > num_keys:
+            logging.debug("Added %d keys to the fuzzy index of the Goodreads resolution cache",
+                          len(self.tree) - num_keys)
 
-    def __init__(self, cache: dict = {}, is_dirty: bool = True) -> None:
+
+# map from resolution cache file to its fuzzy index, shared by every GoodreadsResolutionCache on that file,
+# so resolving one person after another in the same process doesn't rebuild it
+_fuzzy_indexes: Dict[str, FuzzyResolutionIndex] = {}
+
+
+class GoodreadsResolutionCache:
+    """Map from search string to the book it was resolved to.
+    Backed by SQLite in WAL mode: every resolution is a single-row write, and SQLite's file locking
+    lets several resolvers share the cache at once."""
+    FNAME = "data/goodreads-resolution-cache.db"
+    # the old cache, which pickled the whole dict on every save
+    LEGACY_FNAME = "data/goodreads-resolution-cache.dat"
+    # how long to wait for another resolver to release its lock on the cache, in seconds
+    LOCK_TIMEOUT = 60
+
+    def __init__(self, fname: Optional[str] = None) -> None:
         """
-        :param cache:       Can start with a pre-populated cache
-        :param is_dirty:    Set to true by default.
-                            If false, will not write to disk unless changes are made.
+        :param fname:       Defaults to FNAME
         """
-        self.cache = cache
-        self.is_dirty = is_dirty
+        self.fname = fname or GoodreadsResolutionCache.FNAME
+        dirname = os.path.dirname(self.fname)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.conn = sqlite3.connect(self.fname, timeout=GoodreadsResolutionCache.LOCK_TIMEOUT)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS resolutions (
+            search_str TEXT PRIMARY KEY,
+            goodreads_id INTEGER NOT NULL,
+            book TEXT NOT NULL
+        )""")
+        self.conn.commit()
+        self.is_dirty = False
+        self.migrate_pickled_books()
 
     @staticmethod
-    def load() -> "GoodreadsResolutionCache":
-        with open(GoodreadsResolutionCache.FNAME, "rb") as fp:
-            cache = pickle.load(fp)
-            return GoodreadsResolutionCache(cache, is_dirty=False)
+    def load(fname: Optional[str] = None) -> "GoodreadsResolutionCache":
+        cache = GoodreadsResolutionCache(fname)
+        if len(cache) == 0 and os.path.exists(GoodreadsResolutionCache.LEGACY_FNAME):
+            num_imported = cache.import_legacy(GoodreadsResolutionCache.LEGACY_FNAME)
+            logging.info("Imported %d resolutions from %s", num_imported, GoodreadsResolutionCache.LEGACY_FNAME)
+        return cache
+
+    def import_legacy(self, fname: str) -> int:
+        """Import the old pickled cache. Existing entries are not overwritten.
+        :return:        The number of resolutions imported"""
+        with open(fname, "rb") as fp:
+            legacy_cache = pickle.load(fp)
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO resolutions (search_str, goodreads_id, book) VALUES (?, ?, ?)",
+                [(search_str, entry["goodreads_id"], serialize_book(entry["book"]))
+                 for search_str, entry in legacy_cache.items()]
+            )
+        return len(legacy_cache)
+
+    def migrate_pickled_books(self) -> int:
+        """Books used to be stored pickled, along with their ElementTree node.
+        Rewrite any such rows in the node-free serialization.
+        :return:        The number of rows migrated"""
+        rows = self.conn.execute("SELECT search_str, book FROM resolutions WHERE typeof(book) = 'blob'").fetchall()
+        if rows:
+            with self.conn:
+                self.conn.executemany(
+                    "UPDATE resolutions SET book = ? WHERE search_str = ?",
+                    [(serialize_book(pickle.loads(book)), search_str) for search_str, book in rows]
+                )
+            logging.info("Migrated %d pickled books in the Goodreads resolution cache", len(rows))
+        return len(rows)
+
+    def close(self) -> None:
+        self.save()
+        self.conn.close()
 
     def save(self) -> None:
         if self.is_dirty:
+            self.conn.commit()
             logging.debug("Saved Goodreads resolution cache to disk")
-            with open(GoodreadsResolutionCache.FNAME, "wb") as fp:
-                pickle.dump(self.cache, fp)
             self.is_dirty = False
 
     def __contains__(self, search_str: str) -> bool:
-        return search_str in self.cache
+        row = self.conn.execute("SELECT 1 FROM resolutions WHERE search_str = ?", (search_str,)).fetchone()
+        return row is not None
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM resolutions").fetchone()[0]
 
     def save_title_resolution(self, search_str: str, goodreads_id: int, book: GoodreadsBook) -> None:
-        if search_str not in self.cache:
-            self.cache[search_str] = {}
-        self.cache[search_str]["goodreads_id"] = goodreads_id
-        self.cache[search_str]["book"] = book
+        self.conn.execute("INSERT OR REPLACE INTO resolutions (search_str, goodreads_id, book) VALUES (?, ?, ?)",
+                          (search_str, goodreads_id, serialize_book(book)))
         self.is_dirty = True
 
     def get_book(self, search_str: str) -> GoodreadsBook:
-        return self.cache[search_str]["book"]
+        row = self.conn.execute("SELECT book FROM resolutions WHERE search_str = ?", (search_str,)).fetchone()
+        if row is None:
+            raise KeyError(search_str)
+        return deserialize_book(row[0])
+
+    def get_fuzzy_index(self) -> FuzzyResolutionIndex:
+        """The fuzzy index of this cache's file, brought up to date"""
+        fname = os.path.abspath(self.fname)
+        fuzzy_index = _fuzzy_indexes.get(fname)
+        if fuzzy_index is None:
+            fuzzy_index = _fuzzy_indexes[fname] = FuzzyResolutionIndex()
+        fuzzy_index.update(self.conn)
+        return fuzzy_index
+
+    def find_similar(self, query: str, max_distance: int = DEFAULT_MAX_FUZZY_DISTANCE) -> Optional[Tuple[str, int]]:
+        """Find a resolved query which is probably asking for the same book as this one.
+        Queries are compared after normalizing case and whitespace, against the fuzzy keys of each resolution
+        (see get_fuzzy_keys). Nothing is returned if the closest keys belong to different books.
+        Keys with different numbers or roman numerals are never matched, since they are likely other volumes.
+        :param max_distance:    -1 to never match
+        :return:                (resolved query, edit distance), or None if there is no such query"""
+        if max_distance < 0:
+            return None
+        fuzzy_index = self.get_fuzzy_index()
+        normalized_query = normalize_query(query)
+        max_distance = min(max_distance, len(normalized_query) // FUZZY_CHARS_PER_EDIT)
+        volume_numbers = get_volume_numbers(normalized_query)
+        matches = [(d, key, value) for d, key, value in fuzzy_index.tree.search(normalized_query, max_distance)
+                   if get_volume_numbers(key) == volume_numbers]
+        if matches == []:
+            return None
+        best_distance = min(d for d, _, _ in matches)
+        best = set(value for d, _, value in matches if d == best_distance)
+        if len(set(goodreads_id for _, goodreads_id in best)) > 1:
+            logging.debug("'%s' is equally close to resolutions of different books, not using any of them", query)
+            return None
+        return min(search_str for search_str, _ in best), best_distance
 
 
 class GoodreadsResolutionException(Exception):
@@ -235,6 +806,12 @@ class GoodreadsResolutionException(Exception):
     pass
 
 
+class GoodreadsFetchException(GoodreadsResolutionException):
+    """This exception is raised when the Goodreads API can't be reached,
+    or keeps failing even after retrying"""
+    pass
+
+
 class NoCacheOverrideException(GoodreadsResolutionException):
     """This exception is raised when a cache exists for a person
     and the user chooses to not override it"""
@@ -256,62 +833,122 @@ def skip_or_exit() -> bool:
         raise SystemExit()
 
 
+def resolve_query(book: str, goodreads_resolution_cache: GoodreadsResolutionCache,
+                  person: Optional[str] = None,
+                  review_queue: Optional[ReviewQueue] = None,
+                  max_fuzzy_distance: int = DEFAULT_MAX_FUZZY_DISTANCE) -> Optional[GoodreadsBook]:
+    """Resolve a single query, asking the user if there is no obviously correct book
+    :param book:                The query
+    :param person:              Whose query this is
+    :param review_queue:        If set, resolve unattended: instead of asking the user, queue the query for review
+    :param max_fuzzy_distance:  See GoodreadsResolutionCache.find_similar
+    :return:                    None if the user chose to skip this query, or it was queued for review"""
+    if book in goodreads_resolution_cache:
+        logging.info("Found '%s' in Goodreads resolution cache", book)
+        profiler.count("resolution_cache.hit")
+        return goodreads_resolution_cache.get_book(book)
+    similar = goodreads_resolution_cache.find_similar(book, max_fuzzy_distance)
+    if similar is not None:
+        similar_query, d = similar
+        logging.info("Fuzzy hit in Goodreads resolution cache: '%s' is close to '%s' (distance %d)",
+                     book, similar_query, d)
+        profiler.count("resolution_cache.fuzzy_hit")
+        # not saved as a resolution of this query, so a wrong match isn't made permanent,
+        # nor used as a key for further fuzzy matches
+        return goodreads_resolution_cache.get_book(similar_query)
+    profiler.count("resolution_cache.miss")
+    if review_queue is not None and book in review_queue:
+        logging.info("'%s' is already queued for review", book)
+        # it may be queued because of another person
+        review_queue.add(book, [], person)
+        return None
+    logging.info("Searching for '%s' on goodreads for person %s...", book, person)
+    candidates = search_for_book(book)
+    relevant_books = suggest_book_from_results(book, candidates)
+    if review_queue is not None and (relevant_books == [] or
+                                     (len(relevant_books) > 1 and get_obviously_correct_book(relevant_books) is None)):
+        logging.info("Queued '%s' for review", book)
+        review_queue.add(book, relevant_books, person)
+        return None
+    if relevant_books == []:
+        print("WARNING: no results for query \"{}\"".format(book))
+        print("Possible typo?")
+        skip_or_exit()
+        return None
+    elif len(relevant_books) == 1:
+        candidate = relevant_books[0]
+    else:
+        candidate = get_obviously_correct_book(relevant_books)
+        if candidate:
+            logging.debug("We have a winner!")
+        else:
+            logging.debug("No obviously correct book")
+            try:
+                candidate = resolve_via_human(book, relevant_books)
+            except NoBookSelectedException:
+                skip_or_exit()
+                return None
+    goodreads_resolution_cache.save_title_resolution(book, candidate.get_goodreads_id(), candidate)
+    goodreads_resolution_cache.save()
+    return candidate
+
+
 def main(args) -> bool:
     """
     Perform book resolution using goodreads and the command line for the given person
     :return:        If the resolution cache exists, return true iff it has been override
                     If it does *not* exist, return true
     """
-    setup_logging(not args.quiet)
-    chosen_books = []
+    setup_logging(not args.quiet, profile=args.profile)
+    set_cache_ttl(args.cache_ttl_days)
+    set_requests_per_second(args.requests_per_second)
     output_fname = get_output_fname(args.person)
-    try:
-        goodreads_resolution_cache = GoodreadsResolutionCache.load()
-    except IOError:
-        goodreads_resolution_cache = GoodreadsResolutionCache()
-        goodreads_resolution_cache.save()
-    if os.path.exists(output_fname):
+    picks_writer = ResolvedPicksWriter(args.person, args.book_file)
+    review_queue = ReviewQueue.load()
+    has_checkpoint = picks_writer.has_checkpoint()
+    if not has_checkpoint:
+        # a checkpoint of another version of the picks file, or without its partial file, can't be resumed
+        picks_writer.discard()
+    if has_checkpoint:
+        logging.info("Resolution of %s's picks was interrupted, resuming", args.person)
+    elif os.path.exists(output_fname) and review_queue.is_waiting(args.person):
+        logging.info("Resolved picks file for %s is partial, resolving again", args.person)
+    elif os.path.exists(output_fname):
         if args.always_use_cache:
             logging.warning("Resolved picks file already exists for %s. Not overwriting.", args.person)
             raise NoCacheOverrideException()
         print("Resolved picks file already exists for {}.".format(args.person))
         if not confirm("Overwrite?"):
             raise NoCacheOverrideException()
-    for book in get_books_from_file(args.book_file):
-        # the 'book' is actually a query
-        if book in goodreads_resolution_cache:
-            logging.info("Found '%s' in Goodreads resolution cache", book)
-            candidate = goodreads_resolution_cache.get_book(book)
-            chosen_books.append(candidate)
-        else:
-            logging.info("Searching for '%s' on goodreads for person %s...", book, args.person)
-            root = search_for_book(book)
-            relevant_books = suggest_book_from_results(book, root)
-            if relevant_books == []:
-                print("WARNING: no results for query \"{}\"".format(book))
-                print("Possible typo?")
-                if skip_or_exit():
-                    continue
-                # basically not skipping will write
-            elif len(relevant_books) == 1:
-                candidate = relevant_books[0]
-            else:
-                candidate = get_obviously_correct_book(relevant_books)
-                if candidate:
-                    logging.debug("We have a winner!")
-                else:
-                    logging.debug("No obviously correct book")
-                    try:
-                        candidate = resolve_via_human(book, relevant_books)
-                    except NoBookSelectedException:
-                        if skip_or_exit():
-                            continue
-
-            goodreads_resolution_cache.save_title_resolution(book, candidate.get_goodreads_id(), candidate)
-            goodreads_resolution_cache.save()
-            chosen_books.append(candidate)
+    goodreads_resolution_cache = GoodreadsResolutionCache.load()
+    queries = list(get_books_from_file(args.book_file))
+    num_done = picks_writer.open()
+    if num_done > 0:
+        logging.info("Already decided %d of %s's %d queries", num_done, args.person, len(queries))
+    else:
+        # the person's picks file is only complete once none of their queries are waiting for review
+        review_queue.clear_person(args.person)
+    if args.jobs > 0:
+        prefetch_books([query for query in queries[num_done:] if query not in goodreads_resolution_cache and
+                        goodreads_resolution_cache.find_similar(query, args.max_fuzzy_distance) is None],
+                       jobs=args.jobs)
+    try:
+        for book in queries[num_done:]:
+            # the 'book' is actually a query
+            candidate = resolve_query(book, goodreads_resolution_cache, args.person,
+                                      review_queue=review_queue if args.unattended else None,
+                                      max_fuzzy_distance=args.max_fuzzy_distance)
+            picks_writer.add(candidate)
+    finally:
+        # on any interruption the checkpoint is kept, so the next run resumes from here
+        picks_writer.close()
+        goodreads_resolution_cache.close()
+    wait_for_revalidation()
+    if review_queue.is_waiting(args.person):
+        logging.warning("Some of %s's picks are queued for review, saving partial choices", args.person)
+    review_queue.close()
     # create the candidates pool
-    save_chosen_books(args.person, chosen_books)
+    picks_writer.finish()
     return True
 
 
@@ -324,6 +961,20 @@ if __name__ == "__main__":
     parser.add_argument("-q", "--quiet", action="store_true")
     parser.add_argument("--always-use-cache", action="store_true", default=False,
                         help="Never ask to overwrite the resolution cache for a person")
+    parser.add_argument("--unattended", action="store_true", default=False,
+                        help="Never prompt. Queue ambiguous queries for review instead.")
+    parser.add_argument("-j", "--jobs", type=int, default=DEFAULT_PREFETCH_JOBS,
+                        help="Number of threads used to prefetch uncached queries. 0 disables prefetching.")
+    parser.add_argument("--requests-per-second", type=float, default=DEFAULT_REQUESTS_PER_SECOND,
+                        help="Maximum rate of requests to the Goodreads API, including prefetching "
+                             "and background refetching")
+    parser.add_argument("--max-fuzzy-distance", type=int, default=DEFAULT_MAX_FUZZY_DISTANCE,
+                        help="Answer queries within this edit distance of an already resolved query or title "
+                             "from the resolution cache. -1 to only answer exact queries from the cache.")
+    parser.add_argument("--cache-ttl-days", type=float, default=DEFAULT_CACHE_TTL_DAYS,
+                        help="Refetch cached Goodreads search responses older than this in the background. "
+                             "-1 to never refetch.")
+    add_profile_argument(parser)
     args = parser.parse_args()
     try:
         main(args)
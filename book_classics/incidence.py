@@ -0,0 +1,70 @@
+"""
+Sparse person x book incidence matrix.
+
+Rows are people, columns are books and each entry is the number of times that person selected that book.
+Built once, then any per-person statistic over any cohort is a handful of sparse reductions.
+"""
+
+from typing import TYPE_CHECKING, Dict, Hashable, List, Optional
+
+import numpy as np
+
+if TYPE_CHECKING:
+    # scipy is slow to import, and incremental scoring never builds a matrix
+    from scipy import sparse
+
+
+class PersonBookIncidence:
+    def __init__(self, people: List[str], book_ids: List[Hashable], matrix: "sparse.csr_matrix") -> None:
+        """
+        :param people:      Row labels
+        :param book_ids:    Column labels
+        :param matrix:      CSR matrix of shape (len(people), len(book_ids))
+        """
+        assert matrix.shape == (len(people), len(book_ids))
+        self.people = people
+        self.book_ids = book_ids
+        self.matrix = matrix
+        self.person_index = {person: i for i, person in enumerate(people)}
+
+    @staticmethod
+    def from_person_to_books(person_to_books: Dict[str, List[Hashable]]) -> "PersonBookIncidence":
+        people = list(person_to_books)
+        book_index = {}  # type: Dict[Hashable, int]
+        rows = []
+        cols = []
+        for row, person in enumerate(people):
+            for book_id in person_to_books[person]:
+                col = book_index.setdefault(book_id, len(book_index))
+                rows.append(row)
+                cols.append(col)
+        book_ids = [None] * len(book_index)  # type: List[Hashable]
+        for book_id, col in book_index.items():
+            book_ids[col] = book_id
+        from scipy import sparse
+        data = np.ones(len(rows), dtype=np.int32)
+        # duplicate (row, col) entries are summed on conversion to CSR
+        matrix = sparse.coo_matrix((data, (rows, cols)), shape=(len(people), len(book_ids))).tocsr()
+        return PersonBookIncidence(people, book_ids, matrix)
+
+    def get_rows(self, cohort: Optional[List[str]] = None) -> np.ndarray:
+        if cohort is None:
+            return np.arange(len(self.people))
+        return np.array([self.person_index[person] for person in cohort], dtype=np.int64)
+
+    def basic_bitch_scores(self, cohort: Optional[List[str]] = None) -> Dict[str, float]:
+        """
+        basic bitch score = (# books you selected that someone else also selected) / (# books you selected)
+        'someone else' is anyone in the cohort
+        :param cohort:      When None it means everyone
+        """
+        rows = self.get_rows(cohort)
+        sub = self.matrix[rows]
+        # number of selections of each book within the cohort
+        book_counts = np.asarray(sub.sum(axis=0)).ravel()
+        shared = (book_counts > 1).astype(np.int64)
+        shared_counts = sub.dot(shared)
+        your_counts = np.asarray(sub.sum(axis=1)).ravel()
+        assert (your_counts > 0).all()
+        scores = shared_counts / your_counts
+        return {self.people[row]: float(score) for row, score in zip(rows, scores)}
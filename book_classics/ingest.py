@@ -0,0 +1,174 @@
+"""
+Turn the survey response matrix into one raw picks file per person.
+
+The matrix has one row per book and one column per person, with an "x" where the person picked the book:
+
+    Book,Year,Author,Votes in Common,Nastya Ambr,...
+    Война и мир,1869,Лев Толстой,3,x,...
+
+Each person's picks are written to data/raw-picks/$name.txt, one book per line, in the order of the rows.
+The matrix is read once, a row at a time. Picks are buffered and appended to the raw picks files in chunks,
+so memory use is bounded however many rows or people the survey has. The files are written next to
+the old ones and only replace them once the whole matrix has been read.
+
+    python book_classics/ingest.py books-responses.csv
+
+This replaces transfer-csv-matrix-into-per-person-file.ipynb.
+"""
+
+import csv
+import logging
+import os
+from argparse import ArgumentParser
+from typing import Dict, List, Tuple
+
+from log_utils import add_profile_argument, profiler, setup_logging
+
+RAW_PICKS_DIR = "data/raw-picks"
+DEFAULT_RESPONSES_FNAME = "books-responses.csv"
+# columns of the matrix which are about the book rather than a person
+BOOK_COLUMNS = ["Book", "Year", "Author", "Votes in Common"]
+# the most picks to hold in memory before appending them to the raw picks files
+DEFAULT_MAX_BUFFERED_PICKS = 100000
+
+
+def get_raw_picks_fname(person: str, dirname: str = RAW_PICKS_DIR) -> str:
+    return os.path.join(dirname, "{}.txt".format(person.replace(" ", "_")))
+
+
+def clean_header(header: List[str]) -> List[str]:
+    """Spreadsheet exports put a byte order mark in front of the first column name, whichever column that is,
+    and add columns with no name for empty columns"""
+    return [name.replace("\ufeff", "").strip() for name in header]
+
+
+def get_person_columns(header: List[str]) -> Tuple[int, Dict[str, List[int]]]:
+    """
+    :param header:      Cleaned column names
+    :return:            (index of the book column, map from person to the indices of their columns)
+                        A person normally has one column, but if a column is repeated the picks from both are kept
+    """
+    if "Book" not in header:
+        raise ValueError("No 'Book' column in the survey responses header: {}".format(header))
+    person_columns: Dict[str, List[int]] = {}
+    for i, name in enumerate(header):
+        if name and name not in BOOK_COLUMNS:
+            if name in person_columns:
+                logging.warning("Column for %s is repeated, keeping the picks from all of them", name)
+            person_columns.setdefault(name, []).append(i)
+    return header.index("Book"), person_columns
+
+
+def is_picked(cell: str) -> bool:
+    return cell.strip().lower() == "x"
+
+
+class RawPicksWriter:
+    """Appends picks to per-person temporary files in chunks, then moves the files into place.
+    Only a bounded number of picks is held in memory, and no file is kept open between chunks,
+    so neither the length nor the width of the survey is limited by memory or open file handles."""
+
+    def __init__(self, people: List[str], dirname: str = RAW_PICKS_DIR,
+                 max_buffered_picks: int = DEFAULT_MAX_BUFFERED_PICKS) -> None:
+        assert max_buffered_picks > 0
+        self.dirname = dirname
+        self.max_buffered_picks = max_buffered_picks
+        self.buffers: Dict[str, List[str]] = {person: [] for person in people}
+        self.num_buffered = 0
+        self.num_picks = 0
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        # every person gets a file, even if they picked nothing
+        for person in people:
+            open(self.get_tmp_fname(person), "w").close()
+
+    def get_tmp_fname(self, person: str) -> str:
+        return get_raw_picks_fname(person, self.dirname) + ".tmp"
+
+    def add(self, person: str, book: str) -> None:
+        self.buffers[person].append(book)
+        self.num_buffered += 1
+        self.num_picks += 1
+        if self.num_buffered >= self.max_buffered_picks:
+            self.flush()
+
+    def flush(self) -> None:
+        with profiler.span("ingest.flush"):
+            for person, books in self.buffers.items():
+                if not books:
+                    continue
+                with open(self.get_tmp_fname(person), "a") as fp:
+                    for book in books:
+                        fp.write(book + "\n")
+                books.clear()
+        self.num_buffered = 0
+
+    def finish(self) -> None:
+        self.flush()
+        num_overwritten = 0
+        for person in self.buffers:
+            fname = get_raw_picks_fname(person, self.dirname)
+            if os.path.exists(fname):
+                num_overwritten += 1
+            os.replace(self.get_tmp_fname(person), fname)
+        if num_overwritten > 0:
+            logging.warning("Overwrote the raw picks files of %d people", num_overwritten)
+
+    def discard(self) -> None:
+        for person in self.buffers:
+            tmp_fname = self.get_tmp_fname(person)
+            if os.path.exists(tmp_fname):
+                os.remove(tmp_fname)
+
+
+def ingest_responses(fname: str = DEFAULT_RESPONSES_FNAME, dirname: str = RAW_PICKS_DIR,
+                     max_buffered_picks: int = DEFAULT_MAX_BUFFERED_PICKS) -> Dict[str, int]:
+    """Write a raw picks file for every person in the survey responses matrix, in a single pass over it
+    :param max_buffered_picks:  The most picks to hold in memory at once
+    :return:                    Counts of what was read and written"""
+    num_rows = 0
+    # utf-8-sig drops a byte order mark at the start of the file. clean_header deals with any others.
+    with open(fname, encoding="utf-8-sig", newline="") as fp:
+        reader = csv.reader(fp)
+        try:
+            header = clean_header(next(reader))
+        except StopIteration:
+            raise ValueError("Survey responses file {} is empty".format(fname))
+        book_column, person_columns = get_person_columns(header)
+        writer = RawPicksWriter(list(person_columns), dirname, max_buffered_picks)
+        try:
+            for row in reader:
+                num_rows += 1
+                if book_column >= len(row) or not row[book_column].strip():
+                    continue
+                # one book per line in the raw picks files
+                book = " ".join(row[book_column].split())
+                for person, columns in person_columns.items():
+                    if any(i < len(row) and is_picked(row[i]) for i in columns):
+                        writer.add(person, book)
+            writer.finish()
+        except BaseException:
+            writer.discard()
+            raise
+    profiler.count("ingest.rows", num_rows)
+    profiler.count("ingest.picks", writer.num_picks)
+    counts = {
+        "rows": num_rows,
+        "people": len(person_columns),
+        "picks": writer.num_picks,
+    }
+    logging.info("Wrote raw picks from %s to %s: %s", fname, dirname, counts)
+    return counts
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("responses", nargs="?", default=DEFAULT_RESPONSES_FNAME,
+                        help="The survey responses matrix, as CSV ({})".format(DEFAULT_RESPONSES_FNAME))
+    parser.add_argument("--out-dir", default=RAW_PICKS_DIR)
+    parser.add_argument("--max-buffered-picks", type=int, default=DEFAULT_MAX_BUFFERED_PICKS,
+                        help="Append picks to the raw picks files whenever this many have been read")
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    setup_logging(verbose=False, profile=args.profile)
+    ingest_responses(args.responses, args.out_dir, args.max_buffered_picks)
@@ -1,15 +1,151 @@
+import atexit
+import bisect
+import json
 import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Iterator, List, Optional
 
-import coloredlogs
+# upper bounds of the histogram buckets for span durations, in milliseconds. The last bucket is unbounded.
+HISTOGRAM_BUCKETS_MS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+DEFAULT_PROFILE_FNAME = "profile.json"
 
 
-def setup_logging(verbose: bool = True) -> None:
+class Profiler:
+    """Counters and timing spans for a run, written out as a JSON report.
+    When disabled, which is the default, recording anything is a single attribute check."""
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.start_time = time.time()
+        self.counters: Counter = Counter()
+        # map from span name to [count, total seconds, max seconds]
+        self.spans: Dict[str, List[float]] = {}
+        # map from span name to the number of durations in each bucket of HISTOGRAM_BUCKETS_MS
+        self.histograms: Dict[str, List[int]] = {}
+        # spans and counters may be recorded from several threads, e.g. when prefetching
+        self.lock = threading.Lock()
+
+    def reset(self) -> None:
+        self.start_time = time.time()
+        self.counters = Counter()
+        self.spans = {}
+        self.histograms = {}
+
+    def count(self, name: str, n: int = 1) -> None:
+        if self.enabled:
+            with self.lock:
+                self.counters[name] += n
+
+    def observe(self, name: str, seconds: float) -> None:
+        """Record one duration of the span"""
+        if not self.enabled:
+            return
+        bucket = bisect.bisect_left(HISTOGRAM_BUCKETS_MS, seconds * 1000)
+        with self.lock:
+            stats = self.spans.setdefault(name, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            histogram = self.histograms.setdefault(name, [0] * (len(HISTOGRAM_BUCKETS_MS) + 1))
+            histogram[bucket] += 1
+
+    def span(self, name: str):
+        """Context manager which times its body as one duration of the span"""
+        if not self.enabled:
+            return _NULL_SPAN
+        return self._timed(name)
+
+    @contextmanager
+    def _timed(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def get_state(self) -> dict:
+        """Everything recorded so far, in a form which can be merged into another profiler"""
+        return {
+            "counters": dict(self.counters),
+            "spans": self.spans,
+            "histograms": self.histograms,
+        }
+
+    def merge(self, state: dict) -> None:
+        """Add what another profiler recorded, e.g. in a worker process"""
+        self.counters.update(state["counters"])
+        for name, (count, total, max_seconds) in state["spans"].items():
+            stats = self.spans.setdefault(name, [0, 0.0, 0.0])
+            stats[0] += count
+            stats[1] += total
+            stats[2] = max(stats[2], max_seconds)
+        for name, histogram in state["histograms"].items():
+            merged = self.histograms.setdefault(name, [0] * (len(HISTOGRAM_BUCKETS_MS) + 1))
+            for i, n in enumerate(histogram):
+                merged[i] += n
+
+    def get_report(self) -> dict:
+        bucket_names = ["<={}ms".format(ms) for ms in HISTOGRAM_BUCKETS_MS] + [">{}ms".format(HISTOGRAM_BUCKETS_MS[-1])]
+        spans = {}
+        for name, (count, total, max_seconds) in sorted(self.spans.items()):
+            spans[name] = {
+                "count": count,
+                "total_seconds": total,
+                "mean_seconds": total / count,
+                "max_seconds": max_seconds,
+                "histogram": {bucket: n for bucket, n in zip(bucket_names, self.histograms[name]) if n > 0},
+            }
+        return {
+            "command": " ".join(sys.argv),
+            "wall_seconds": time.time() - self.start_time,
+            "counters": dict(sorted(self.counters.items())),
+            "spans": spans,
+        }
+
+    def write_report(self, fname: str) -> None:
+        with open(fname, "w") as fp:
+            json.dump(self.get_report(), fp, indent=2)
+        logging.info("Wrote profile to %s", fname)
+
+
+_NULL_SPAN = nullcontext()
+profiler = Profiler()
+
+
+def enable_profiling(report_fname: str = DEFAULT_PROFILE_FNAME) -> None:
+    """Start recording, and write the report to report_fname when the program exits"""
+    if profiler.enabled:
+        return
+    profiler.enabled = True
+    profiler.reset()
+    atexit.register(profiler.write_report, os.path.abspath(report_fname))
+
+
+def add_profile_argument(parser) -> None:
+    parser.add_argument("--profile", nargs="?", const=DEFAULT_PROFILE_FNAME, default=None, metavar="FNAME",
+                        help="Record timings and counters, and write them as JSON to FNAME ({}) at exit".format(
+                            DEFAULT_PROFILE_FNAME))
+
+
+def setup_logging(verbose: bool = True, profile: Optional[str] = None) -> None:
+    """
+    :param profile:     If set, enable profiling and write the report to this file at exit
+    """
     if verbose:
         log_level = logging.DEBUG
     else:
         log_level = logging.INFO
     logging.basicConfig(level=log_level,
                         format="[%(name)s %(levelname)s] %(message)s")
+    # imported here since it takes longer to import than everything else in a cached run
+    import coloredlogs
     coloredlogs.install(level=log_level)
     for module in ["requests", "urllib3"]:
         logging.getLogger(module).setLevel(logging.WARNING)
+    if profile is not None:
+        enable_profiling(profile)
@@ -0,0 +1,273 @@
+"""
+Local stand-in for the Goodreads search API and Russian Wikipedia, for load-testing the resolvers offline.
+
+Goodreads searches are answered from the Goodreads search cache and Wikipedia pages from the wiki cache.
+Anything not cached gets an empty search result or a missing page,
+unless --synthetic-books is given, in which case it gets a synthetic one (see synthetic_corpus.py).
+Latency, server errors and rate limiting can be injected, to see how the resolvers cope with them.
+
+    python book_classics/replay_server.py --port 8000 --latency 200 --error-rate 0.05 --rate-limit 10
+
+Then point the resolvers at it:
+
+    GOODREADS_BASE_URL=http://localhost:8000 WIKIPEDIA_BASE_URL=http://localhost:8000 GOODREADS_API_KEY=x \\
+        python book_classics/resolve_books.py --batch --unattended
+"""
+
+import json
+import logging
+import random
+import signal
+import sys
+import threading
+import time
+import urllib.parse
+import zlib
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+from log_utils import setup_logging
+from ru_wiki import WikiCache, get_html_fname, read_html
+from search_cache import GoodreadsSearchCache, normalize_query
+from synthetic_corpus import get_author, get_search_response, get_wikipedia_article, get_year
+
+EMPTY_SEARCH_RESPONSE = """<?xml version="1.0" encoding="UTF-8"?>
+<GoodreadsResponse>
+<search>
+<query><![CDATA[{query}]]></query>
+<results-start>0</results-start>
+<results-end>0</results-end>
+<total-results>0</total-results>
+<results>
+</results>
+</search>
+</GoodreadsResponse>"""
+
+
+class TokenBucket:
+    """Thread-safe rate limiter which allows bursts of up to `burst` requests"""
+
+    def __init__(self, requests_per_second: float, burst: int = 1) -> None:
+        assert requests_per_second > 0
+        self.rate = requests_per_second
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.last_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        """:return: False if the request is over the rate limit"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+            self.last_time = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class ReplayServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, search_responses: Dict[str, bytes], wiki_pages: Dict[str, str],
+                 latency: float = 0, latency_jitter: float = 0, error_rate: float = 0,
+                 rate_limit: Optional[float] = None, rate_limit_burst: int = 1,
+                 synthetic_books: Optional[int] = None, seed: int = 0) -> None:
+        """
+        :param search_responses:    map from normalized query to zlib-compressed XML
+        :param wiki_pages:          map from page title to its HTML file
+        :param latency:             seconds added to every response
+        :param latency_jitter:      up to this many more seconds are added at random
+        :param error_rate:          fraction of requests answered with a 503
+        :param rate_limit:          requests per second beyond which requests are answered with a 429
+        :param synthetic_books:     if set, uncached searches and pages get synthetic answers from this many books
+        """
+        super().__init__(address, ReplayRequestHandler)
+        self.search_responses = search_responses
+        self.wiki_pages = wiki_pages
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.rate_limiter = TokenBucket(rate_limit, rate_limit_burst) if rate_limit else None
+        self.synthetic_books = synthetic_books
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.stats = {"requests": 0, "errors": 0, "rate_limited": 0, "misses": 0}
+
+    def count(self, stat: str) -> None:
+        with self.stats_lock:
+            self.stats[stat] += 1
+
+    def random(self) -> float:
+        with self.rng_lock:
+            return self.rng.random()
+
+    def get_search_response(self, query: str) -> str:
+        normalized_query = normalize_query(query)
+        if normalized_query in self.search_responses:
+            return zlib.decompress(self.search_responses[normalized_query]).decode("utf-8")
+        self.count("misses")
+        if self.synthetic_books:
+            book_id = zlib.crc32(normalized_query.encode("utf-8")) % self.synthetic_books
+            return get_search_response(query, book_id, self.synthetic_books)
+        return EMPTY_SEARCH_RESPONSE.format(query=query)
+
+    def has_page(self, title: str) -> bool:
+        return title in self.wiki_pages or bool(self.synthetic_books)
+
+    def get_page(self, title: str) -> Optional[str]:
+        if title in self.wiki_pages:
+            return read_html(self.wiki_pages[title])
+        self.count("misses")
+        if self.synthetic_books:
+            book_id = zlib.crc32(title.encode("utf-8")) % self.synthetic_books
+            return get_wikipedia_article(title, get_author(book_id), get_year(book_id))
+        return None
+
+
+class ReplayRequestHandler(BaseHTTPRequestHandler):
+    server: ReplayServer
+
+    def log_message(self, format: str, *args) -> None:
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+    def send_body(self, status: int, body: str, content_type: str, headers: Optional[Dict[str, str]] = None) -> None:
+        data = body.encode("utf-8")
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def get_params(self) -> Dict[str, str]:
+        """Parameters from both the query string and the body,
+        since the Goodreads client sends its form data in the body of a GET"""
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > 0:
+            params.update(urllib.parse.parse_qsl(self.rfile.read(length).decode("utf-8")))
+        return params
+
+    def do_GET(self) -> None:
+        server = self.server
+        server.count("requests")
+        params = self.get_params()
+        if server.rate_limiter is not None and not server.rate_limiter.try_acquire():
+            server.count("rate_limited")
+            self.send_response(429)
+            self.send_header("Retry-After", "1")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if server.latency or server.latency_jitter:
+            time.sleep(server.latency + server.latency_jitter * server.random())
+        if server.error_rate and server.random() < server.error_rate:
+            server.count("errors")
+            self.send_body(503, "Service Unavailable", "text/plain")
+            return
+        path = urllib.parse.urlsplit(self.path).path
+        if path == "/search/index.xml":
+            response = server.get_search_response(params.get("q", ""))
+            etag = '"{:08x}"'.format(zlib.crc32(response.encode("utf-8")))
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+            else:
+                self.send_body(200, response, "application/xml", {"ETag": etag})
+        elif path == "/w/api.php":
+            self.send_body(200, json.dumps(self.query_titles(params.get("titles", ""))), "application/json")
+        elif path.startswith("/wiki/"):
+            title = urllib.parse.unquote_plus(path[len("/wiki/"):]).replace("_", " ")
+            html = server.get_page(title)
+            if html is None:
+                self.send_body(404, "Not Found", "text/plain")
+            else:
+                self.send_body(200, html, "text/html; charset=UTF-8")
+        else:
+            self.send_body(404, "Not Found", "text/plain")
+
+    do_POST = do_GET
+
+    def query_titles(self, titles: str) -> dict:
+        """Answer a MediaWiki 'action=query' request for one or more titles, separated by '|'"""
+        normalized = []
+        pages = {}
+        for i, title in enumerate(t for t in titles.split("|") if t):
+            # the API capitalizes the first letter, and so do we
+            to_title = title[0].upper() + title[1:]
+            if to_title != title:
+                normalized.append({"from": title, "to": to_title})
+            if self.server.has_page(to_title):
+                page_id = zlib.crc32(to_title.encode("utf-8"))
+                pages[str(page_id)] = {"pageid": page_id, "ns": 0, "title": to_title}
+            else:
+                pages[str(-1 - i)] = {"ns": 0, "title": to_title, "missing": ""}
+        query: dict = {"pages": pages}
+        if normalized:
+            query["normalized"] = normalized
+        return {"batchcomplete": "", "query": query}
+
+
+def load_search_responses(fname: Optional[str] = None) -> Dict[str, bytes]:
+    """:return: map from normalized query to the compressed response, for every response in the search cache"""
+    search_cache = GoodreadsSearchCache(fname)
+    responses = dict(search_cache.conn.execute("SELECT query, xml FROM search_results"))
+    search_cache.close()
+    return responses
+
+
+def load_wiki_pages() -> Dict[str, str]:
+    """:return: map from page title to its HTML file, for every page in the wiki cache"""
+    try:
+        wiki_cache = WikiCache.load()
+    except IOError:
+        return {}
+    return {entry["page_title"]: get_html_fname(entry["content_hash"])
+            for entry in wiki_cache.searches.values() if entry["page_title"]}
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0,
+                        help="Milliseconds added to every response")
+    parser.add_argument("--latency-jitter", type=float, default=0,
+                        help="Up to this many more milliseconds are added at random")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="Fraction of requests answered with a 503")
+    parser.add_argument("--rate-limit", type=float,
+                        help="Requests per second beyond which requests are answered with a 429")
+    parser.add_argument("--rate-limit-burst", type=int, default=1)
+    parser.add_argument("--synthetic-books", type=int,
+                        help="Answer uncached searches and pages with synthetic ones from this many books")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    setup_logging(args.verbose)
+    search_responses = load_search_responses()
+    wiki_pages = load_wiki_pages()
+    server = ReplayServer((args.host, args.port), search_responses, wiki_pages,
+                          latency=args.latency / 1000, latency_jitter=args.latency_jitter / 1000,
+                          error_rate=args.error_rate, rate_limit=args.rate_limit,
+                          rate_limit_burst=args.rate_limit_burst, synthetic_books=args.synthetic_books,
+                          seed=args.seed)
+    logging.info("Replaying %d Goodreads searches and %d Wikipedia pages on http://%s:%d",
+                 len(search_responses), len(wiki_pages), args.host, args.port)
+    # so the stats are logged when the server is killed too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logging.info("Served %s", server.stats)
@@ -2,11 +2,15 @@
 Disambiguate the book names
 """
 
-from typing import List
+from typing import Dict, List, Optional, Set, Tuple
 import os
 import goodreads
-from collections import namedtuple
-from log_utils import setup_logging
+from argparse import ArgumentParser
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from log_utils import add_profile_argument, profiler, setup_logging
+from review_queue import ReviewQueue
+from search_cache import normalize_query
 import logging
 
 
@@ -28,22 +32,261 @@ GoodreadsArgs = namedtuple("GoodreadsArgs", [
     "person",
     "book_file",
     "always_use_cache",
+    "unattended",
+    "jobs",
+    "requests_per_second",
+    "profile",
+    "max_fuzzy_distance",
+    "cache_ttl_days",
 ])
 
 
-if __name__ == "__main__":
-    setup_logging(verbose=True)
-    fnames = get_filenames()
+# outcomes of resolving one person's picks
+RESOLVED = "resolved"
+PARTIAL = "partial"
+NOT_OVERRIDDEN = "not overridden"
+FAILED = "failed"
+
+
+def resolve_person(fname: str, unattended: bool = False, jobs: int = goodreads.DEFAULT_PREFETCH_JOBS,
+                   requests_per_second: float = goodreads.DEFAULT_REQUESTS_PER_SECOND,
+                   max_fuzzy_distance: int = goodreads.DEFAULT_MAX_FUZZY_DISTANCE) -> Tuple[str, str, str]:
+    """Resolve a single person's picks. Failures are returned rather than raised.
+    :return:        (person, outcome, details)"""
+    person_name = get_name_from_filename(fname)
+    logging.debug("Resolving picks for %s", person_name)
+    args = GoodreadsArgs(
+        quiet=False,
+        person=person_name,
+        book_file=fname,
+        always_use_cache=True,
+        unattended=unattended,
+        jobs=jobs,
+        requests_per_second=requests_per_second,
+        # the caller decides whether to profile
+        profile=None,
+        max_fuzzy_distance=max_fuzzy_distance,
+        # set for the whole run with goodreads.set_cache_ttl
+        cache_ttl_days=goodreads.get_cache_ttl_days(),
+    )
+    try:
+        with profiler.span("resolve.person"):
+            goodreads.main(args)
+    except goodreads.NoCacheOverrideException:
+        logging.debug("Not overriding choices for %s", person_name)
+        return person_name, NOT_OVERRIDDEN, ""
+    except Exception as e:
+        logging.exception("Failed to resolve picks for %s", person_name)
+        return person_name, FAILED, "{}: {}".format(type(e).__name__, e)
+    review_queue = ReviewQueue.load()
+    is_waiting = review_queue.is_waiting(person_name)
+    review_queue.close()
+    if is_waiting:
+        return person_name, PARTIAL, "some queries are queued for review"
+    return person_name, RESOLVED, ""
+
+
+def print_summary(outcomes: List[Tuple[str, str, str]]) -> None:
+    counts = Counter(outcome for _, outcome, _ in outcomes)
+    print("Resolved {} people: {}".format(
+        len(outcomes),
+        ", ".join("{} {}".format(counts[outcome], outcome)
+                  for outcome in [RESOLVED, PARTIAL, NOT_OVERRIDDEN, FAILED])
+    ))
+    for person_name, outcome, details in sorted(outcomes):
+        if outcome in [PARTIAL, FAILED]:
+            print("{} {}: {}".format(person_name, outcome, details))
+
+
+def resolve_all(fnames: List[str], unattended: bool = False,
+                jobs: int = goodreads.DEFAULT_PREFETCH_JOBS,
+                requests_per_second: float = goodreads.DEFAULT_REQUESTS_PER_SECOND,
+                max_fuzzy_distance: int = goodreads.DEFAULT_MAX_FUZZY_DISTANCE) -> List[Tuple[str, str, str]]:
+    """Resolve everyone's picks one person at a time
+    :return:        (person, outcome, details) for each person"""
+    return [resolve_person(fname, unattended=unattended, jobs=jobs, requests_per_second=requests_per_second,
+                           max_fuzzy_distance=max_fuzzy_distance)
+            for fname in fnames]
+
+
+def resolve_person_in_worker(fname: str, unattended: bool, jobs: int, requests_per_second: float,
+                             max_fuzzy_distance: int, profile: bool) -> Tuple[Tuple[str, str, str], Optional[dict]]:
+    """resolve_person, in a worker process
+    :return:        (the outcome, what the worker's profiler recorded if profiling)"""
+    profiler.enabled = profile
+    profiler.reset()
+    outcome = resolve_person(fname, unattended, jobs, requests_per_second, max_fuzzy_distance)
+    return outcome, profiler.get_state() if profile else None
+
+
+def resolve_all_parallel(fnames: List[str], num_processes: int,
+                         jobs: int = goodreads.DEFAULT_PREFETCH_JOBS,
+                         requests_per_second: float = goodreads.DEFAULT_REQUESTS_PER_SECOND,
+                         max_fuzzy_distance: int = goodreads.DEFAULT_MAX_FUZZY_DISTANCE
+                         ) -> List[Tuple[str, str, str]]:
+    """Resolve everyone's picks on a pool of processes.
+    Workers can't prompt, so this is always unattended.
+    The workers share the resolution cache, search cache and review queue, which are all SQLite databases.
+    :param jobs:                    Prefetch threads per process
+    :param requests_per_second:     Shared between all the processes
+    :return:                        (person, outcome, details) for each person"""
+    worker_requests_per_second = requests_per_second / num_processes
+    outcomes = []
+    with ProcessPoolExecutor(max_workers=num_processes) as executor:
+        futures = [executor.submit(resolve_person_in_worker, fname, True, jobs, worker_requests_per_second,
+                                   max_fuzzy_distance, profiler.enabled)
+                   for fname in fnames]
+        for fname, future in zip(fnames, futures):
+            try:
+                outcome, profile_state = future.result()
+                outcomes.append(outcome)
+                if profile_state is not None:
+                    profiler.merge(profile_state)
+            except Exception as e:
+                # e.g. the worker process died
+                outcomes.append((get_name_from_filename(fname), FAILED, "{}: {}".format(type(e).__name__, e)))
+    return outcomes
+
+
+def resolve_all_batch(fnames: List[str], unattended: bool = False, jobs: int = goodreads.DEFAULT_PREFETCH_JOBS,
+                      requests_per_second: float = goodreads.DEFAULT_REQUESTS_PER_SECOND,
+                      max_fuzzy_distance: int = goodreads.DEFAULT_MAX_FUZZY_DISTANCE) -> float:
+    """Resolve everyone's picks at once.
+    Each unique (normalized) query across all the people is resolved only once,
+    then the results are written out to each person's resolved picks file.
+    :return:        The dedup ratio, i.e. total number of queries / number of unique queries"""
+    goodreads.set_requests_per_second(requests_per_second)
+    # map from person to their queries
+    person_to_queries: Dict[str, List[str]] = {}
+    review_queue = ReviewQueue.load()
     for fname in fnames:
         person_name = get_name_from_filename(fname)
-        logging.debug("Resolving picks for %s", person_name)
-        args = GoodreadsArgs(
-            quiet=False,
-            person=person_name,
-            book_file=fname,
-            always_use_cache=True,
-        )
-        try:
-            goodreads.main(args)
-        except goodreads.NoCacheOverrideException:
+        # a person whose resolution was interrupted isn't done, even if they have an older resolved picks file
+        if os.path.exists(goodreads.get_output_fname(person_name)) and not review_queue.is_waiting(person_name) \
+                and not goodreads.ResolvedPicksWriter(person_name, fname).has_checkpoint():
             logging.debug("Not overriding choices for %s", person_name)
+            continue
+        person_to_queries[person_name] = list(goodreads.get_books_from_file(fname))
+    # map from normalized query to all the ways it was written
+    unique_queries: Dict[str, List[str]] = {}
+    # map from normalized query to the people who picked it
+    query_to_people: Dict[str, Set[str]] = {}
+    for person_name, queries in person_to_queries.items():
+        for query in queries:
+            normalized_query = normalize_query(query)
+            variants = unique_queries.setdefault(normalized_query, [])
+            if query not in variants:
+                variants.append(query)
+            query_to_people.setdefault(normalized_query, set([])).add(person_name)
+    num_queries = sum(len(queries) for queries in person_to_queries.values())
+    dedup_ratio = (num_queries * 1.0) / len(unique_queries) if unique_queries else 1.0
+    logging.info("%d queries from %d people, %d unique queries (dedup ratio %.2f)",
+                 num_queries, len(person_to_queries), len(unique_queries), dedup_ratio)
+
+    goodreads_resolution_cache = goodreads.GoodreadsResolutionCache.load()
+    resolved: Dict[str, Optional[goodreads.GoodreadsBook]] = {}
+    uncached = []
+    for normalized_query, variants in unique_queries.items():
+        if not any(variant in goodreads_resolution_cache for variant in variants) and \
+                goodreads_resolution_cache.find_similar(variants[0], max_fuzzy_distance) is None:
+            uncached.append(variants[0])
+    if jobs > 0:
+        goodreads.prefetch_books(uncached, jobs=jobs)
+    for person_name in person_to_queries:
+        review_queue.clear_person(person_name)
+    for normalized_query, variants in unique_queries.items():
+        # prefer a variant we have already resolved
+        query = next((variant for variant in variants if variant in goodreads_resolution_cache), variants[0])
+        book = goodreads.resolve_query(query, goodreads_resolution_cache,
+                                       review_queue=review_queue if unattended else None,
+                                       max_fuzzy_distance=max_fuzzy_distance)
+        resolved[normalized_query] = book
+        if book is None and query in review_queue:
+            for person_name in query_to_people[normalized_query]:
+                review_queue.add(query, [], person_name)
+        # a fuzzy hit isn't saved under the query, and so neither under its variants
+        if book is not None and query in goodreads_resolution_cache:
+            for variant in variants:
+                if variant not in goodreads_resolution_cache:
+                    goodreads_resolution_cache.save_title_resolution(variant, book.get_goodreads_id(), book)
+            goodreads_resolution_cache.save()
+    goodreads_resolution_cache.close()
+
+    for person_name, queries in person_to_queries.items():
+        chosen_books = [resolved[normalize_query(query)] for query in queries]
+        goodreads.save_chosen_books(person_name, [book for book in chosen_books if book is not None])
+    if review_queue.num_pending() > 0:
+        logging.warning("%d queries are queued for review. Run with --review to resolve them.",
+                        review_queue.num_pending())
+    review_queue.close()
+    goodreads.wait_for_revalidation()
+    return dedup_ratio
+
+
+def review(fnames: List[str]) -> None:
+    """Ask the user about every query queued for review, using only local data.
+    Then rewrite the resolved picks of everyone who was waiting on those queries."""
+    goodreads_resolution_cache = goodreads.GoodreadsResolutionCache.load()
+    review_queue = ReviewQueue.load()
+    logging.info("%d queries to review", review_queue.num_pending())
+    for query, candidates in review_queue.get_pending():
+        if query in goodreads_resolution_cache:
+            # already resolved some other way
+            review_queue.mark_resolved(query)
+            continue
+        if candidates == []:
+            print("WARNING: no results for query \"{}\"".format(query))
+            print("Possible typo? Skipping.")
+            review_queue.mark_skipped(query)
+            continue
+        try:
+            book = goodreads.resolve_via_human(query, candidates)
+        except goodreads.NoBookSelectedException:
+            review_queue.mark_skipped(query)
+            continue
+        goodreads_resolution_cache.save_title_resolution(query, book.get_goodreads_id(), book)
+        goodreads_resolution_cache.save()
+        review_queue.mark_resolved(query)
+    goodreads_resolution_cache.close()
+    waiting_people = set(review_queue.get_waiting_people())
+    review_queue.close()
+    # everything is now either in the resolution cache or skipped, so this never touches the network
+    outcomes = resolve_all([fname for fname in fnames if get_name_from_filename(fname) in waiting_people],
+                           unattended=True, jobs=0)
+    print_summary(outcomes)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--batch", action="store_true", default=False,
+                        help="Resolve each unique query across everyone's picks only once")
+    parser.add_argument("--unattended", action="store_true", default=False,
+                        help="Never prompt. Queue ambiguous queries for review and save partial picks.")
+    parser.add_argument("--review", action="store_true", default=False,
+                        help="Review the queries queued by an unattended run, without using the network")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Resolve this many people at once, each in its own process. Implies --unattended.")
+    parser.add_argument("--requests-per-second", type=float, default=goodreads.DEFAULT_REQUESTS_PER_SECOND,
+                        help="Maximum rate of requests to the Goodreads API, shared between all the processes")
+    parser.add_argument("--max-fuzzy-distance", type=int, default=goodreads.DEFAULT_MAX_FUZZY_DISTANCE,
+                        help="Answer queries within this edit distance of an already resolved query or title "
+                             "from the resolution cache. -1 to only answer exact queries from the cache.")
+    parser.add_argument("--cache-ttl-days", type=float, default=goodreads.DEFAULT_CACHE_TTL_DAYS,
+                        help="Refetch cached Goodreads search responses older than this in the background. "
+                             "-1 to never refetch.")
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    setup_logging(verbose=True, profile=args.profile)
+    goodreads.set_cache_ttl(args.cache_ttl_days)
+    fnames = get_filenames()
+    if args.review:
+        review(fnames)
+    elif args.batch:
+        resolve_all_batch(fnames, unattended=args.unattended, requests_per_second=args.requests_per_second,
+                          max_fuzzy_distance=args.max_fuzzy_distance)
+    elif args.jobs > 1:
+        print_summary(resolve_all_parallel(fnames, args.jobs, requests_per_second=args.requests_per_second,
+                                           max_fuzzy_distance=args.max_fuzzy_distance))
+    else:
+        print_summary(resolve_all(fnames, unattended=args.unattended, requests_per_second=args.requests_per_second,
+                                  max_fuzzy_distance=args.max_fuzzy_distance))
@@ -0,0 +1,98 @@
+"""
+Queue of queries which could not be resolved without a human.
+
+When resolving unattended, ambiguous queries (and queries with no results) are stored here
+along with their candidate books, instead of prompting. They can then be reviewed later
+in one go using only local data, with `python book_classics/resolve_books.py --review`.
+"""
+
+import json
+import os
+import sqlite3
+from typing import Iterator, List, Optional, Tuple
+
+from book import GoodreadsBook
+
+PENDING = "pending"
+SKIPPED = "skipped"
+
+
+class ReviewQueue:
+    FNAME = "data/review-queue.db"
+    # how long to wait for another resolver to release its lock on the queue, in seconds
+    LOCK_TIMEOUT = 60
+
+    def __init__(self, fname: Optional[str] = None) -> None:
+        self.fname = fname or ReviewQueue.FNAME
+        dirname = os.path.dirname(self.fname)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.conn = sqlite3.connect(self.fname, timeout=ReviewQueue.LOCK_TIMEOUT)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS review_items (
+            query TEXT PRIMARY KEY,
+            candidates TEXT NOT NULL,
+            status TEXT NOT NULL
+        )""")
+        # people whose resolved picks file is only partial, and the queries they are waiting on
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS waiting_people (
+            person TEXT NOT NULL,
+            query TEXT NOT NULL,
+            PRIMARY KEY (person, query)
+        )""")
+        self.conn.commit()
+
+    @staticmethod
+    def load(fname: Optional[str] = None) -> "ReviewQueue":
+        return ReviewQueue(fname)
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __contains__(self, query: str) -> bool:
+        row = self.conn.execute("SELECT 1 FROM review_items WHERE query = ?", (query,)).fetchone()
+        return row is not None
+
+    def add(self, query: str, candidates: List[GoodreadsBook], person: Optional[str] = None) -> None:
+        """Queue the query for review. If it is already queued, its status is left alone.
+        :param candidates:      Empty if there were no results for the query
+        :param person:          Whose picks are waiting on this query"""
+        with self.conn:
+            self.conn.execute("INSERT OR IGNORE INTO review_items (query, candidates, status) VALUES (?, ?, ?)",
+                              (query, json.dumps([book.to_dict() for book in candidates]), PENDING))
+            if person is not None:
+                # nobody waits on a query that was skipped during review
+                self.conn.execute("""INSERT OR IGNORE INTO waiting_people (person, query)
+                    SELECT ?, query FROM review_items WHERE query = ? AND status = ?""", (person, query, PENDING))
+
+    def get_pending(self) -> Iterator[Tuple[str, List[GoodreadsBook]]]:
+        """:return:     (query, candidates) for every query which still needs to be reviewed"""
+        rows = self.conn.execute("SELECT query, candidates FROM review_items WHERE status = ? ORDER BY query",
+                                 (PENDING,)).fetchall()
+        for query, candidates in rows:
+            yield query, [GoodreadsBook.from_dict(d) for d in json.loads(candidates)]
+
+    def num_pending(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM review_items WHERE status = ?", (PENDING,)).fetchone()[0]
+
+    def mark_resolved(self, query: str) -> None:
+        """The answer is now in the Goodreads resolution cache"""
+        with self.conn:
+            self.conn.execute("DELETE FROM review_items WHERE query = ?", (query,))
+
+    def mark_skipped(self, query: str) -> None:
+        """None of the candidates are right. Don't ask again."""
+        with self.conn:
+            self.conn.execute("UPDATE review_items SET status = ? WHERE query = ?", (SKIPPED, query))
+
+    def is_waiting(self, person: str) -> bool:
+        """:return: True iff the person's resolved picks file is only partial"""
+        row = self.conn.execute("SELECT 1 FROM waiting_people WHERE person = ?", (person,)).fetchone()
+        return row is not None
+
+    def get_waiting_people(self) -> List[str]:
+        return [row[0] for row in self.conn.execute("SELECT DISTINCT person FROM waiting_people ORDER BY person")]
+
+    def clear_person(self, person: str) -> None:
+        with self.conn:
+            self.conn.execute("DELETE FROM waiting_people WHERE person = ?", (person,))
@@ -8,43 +8,99 @@ I have found the following:
 there is no support for using the API to actually get the page content
 """
 
+import glob
+import gzip
+import hashlib
 import logging
 import os
 import pickle
+import time
 import urllib
-import uuid
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pprint
 
 import Levenshtein
-import requests
-import wptools
-from bs4 import BeautifulSoup
-from typing import Optional
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional
 
 from book import Book
-from log_utils import setup_logging
+from log_utils import add_profile_argument, profiler, setup_logging
 
+if TYPE_CHECKING:
+    # requests and the HTML parsers are only imported by the code that uses them,
+    # so a run which is answered entirely from the wiki cache starts quickly
+    import requests
+
+# point this at a local stand-in (see replay_server.py) to run without the real site
+WIKIPEDIA_BASE_URL = os.environ.get("WIKIPEDIA_BASE_URL", "https://ru.wikipedia.org").rstrip("/")
+# WIKIPEDIA_BASE_URL = "https://en.wikipedia.org"
 # this is the query URL
-base_url = "https://ru.wikipedia.org/w/api.php"
-# base_url = "https://en.wikipedia.org/w/api.php"
+base_url = WIKIPEDIA_BASE_URL + "/w/api.php"
 # this is the page info URL
-base_url_info_api = "https://ru.wikipedia.org/api/rest_v1"
-# base_url_info = "https://en.wikipedia.org/api/rest_v1"
-base_url_html = "https://ru.wikipedia.org/wiki"
+base_url_info_api = WIKIPEDIA_BASE_URL + "/api/rest_v1"
+base_url_html = WIKIPEDIA_BASE_URL + "/wiki"
+WIKI_HTML_CACHE_DIR = "data/wikipedia-cache"
+# the MediaWiki API limit on the number of titles in one query
+MAX_TITLES_PER_QUERY = 50
+DEFAULT_FETCH_JOBS = 4
+
+_session: Optional["requests.Session"] = None
+
+
+def get_session() -> "requests.Session":
+    global _session
+    if _session is None:
+        import requests
+        _session = requests.Session()
+    return _session
 
 
 def search_wikipedia_curl(search: str):
     # perform a search to find the article
-    r = requests.get(base_url, params={
-        "format": "json",
-        "action": "query",
-        "titles": search
-    })
+    with profiler.span("http.wikipedia.query"):
+        r = get_session().get(base_url, params={
+            "format": "json",
+            "action": "query",
+            "titles": search
+        })
     data = r.json()
     return data
 
 
+def search_wikipedia_titles(searches: List[str]) -> Dict[str, str]:
+    """Find the page titles for many searches with a single API request
+    :return:        map from search to page title"""
+    assert len(searches) <= MAX_TITLES_PER_QUERY
+    with profiler.span("http.wikipedia.query"):
+        r = get_session().get(base_url, params={
+            "format": "json",
+            "action": "query",
+            "redirects": 1,
+            "titles": "|".join(searches)
+        })
+    data = r.json()
+    return get_page_titles(data, searches)
+
+
+def get_page_titles(data: dict, searches: List[str]) -> Dict[str, str]:
+    """Match up the pages in a multi-title query response with the searches that asked for them"""
+    # the API normalizes the titles we give it, e.g. capitalizing the first letter, then follows redirects
+    normalized = {entry["from"]: entry["to"] for entry in data["query"].get("normalized", [])}
+    redirects = {entry["from"]: entry["to"] for entry in data["query"].get("redirects", [])}
+    # titles which don't exist, or can't, are listed too
+    page_titles = set(page["title"] for page in data["query"]["pages"].values()
+                      if "missing" not in page and "invalid" not in page)
+    titles = {}
+    for search in searches:
+        title = normalized.get(search, search)
+        title = redirects.get(title, title)
+        if title in page_titles:
+            titles[search] = title
+        else:
+            logging.warning("No page found for '%s'", search)
+    return titles
+
+
 def get_page_title(data: dict) -> str:
     page_title = None
     for page_id, page in data["query"]["pages"].items():
@@ -55,30 +111,44 @@ def get_page_title(data: dict) -> str:
 
 
 def search_for_html_page(page_title: str) -> str:
-    r = requests.get("{}/{}".format(
-        base_url_html,
-        urllib.parse.quote_plus(page_title.replace(" ", "_"))
-    ))
+    with profiler.span("http.wikipedia.page"):
+        r = get_session().get("{}/{}".format(
+            base_url_html,
+            urllib.parse.quote_plus(page_title.replace(" ", "_"))
+        ))
     return r.text
 
 
-def save_html(html: str, fname: Optional[str] = None) -> str:
-    if fname is None:
-        fname = "data/wikipedia-cache/{}.html".format(str(uuid.uuid4()))
-    if not os.path.exists("data/wikipedia-cache"):
-        os.mkdir("data/wikipedia-cache")
-    with open(fname, "w") as fp:
-        fp.write(html)
-    return fname
+def get_html_fname(content_hash: str) -> str:
+    return os.path.join(WIKI_HTML_CACHE_DIR, "{}.html.gz".format(content_hash))
+
+
+def save_html(html: str) -> str:
+    """Save the HTML compressed, under its content hash. Identical pages are only stored once.
+    :return:        The content hash"""
+    content_hash = hashlib.sha256(html.encode("utf-8")).hexdigest()
+    fname = get_html_fname(content_hash)
+    if not os.path.exists(WIKI_HTML_CACHE_DIR):
+        os.makedirs(WIKI_HTML_CACHE_DIR)
+    if not os.path.exists(fname):
+        # write to a temp file then move so readers never see a partial file
+        tmp_fname = fname + ".tmp"
+        with gzip.open(tmp_fname, "wt", encoding="utf-8") as fp:
+            fp.write(html)
+        os.replace(tmp_fname, fname)
+    return content_hash
 
 
 def read_html(fname: str) -> str:
+    if fname.endswith(".gz"):
+        with gzip.open(fname, "rt", encoding="utf-8") as fp:
+            return fp.read()
     with open(fname, "r") as fp:
         return fp.read()
 
 
-def get_col_text(col) -> str:
-    col_text = (col.text.translate({
+def clean_col_text(text: str) -> str:
+    col_text = (text.translate({
             ord("\t"): None,
             ord("\n"): None,
             ord("'"): None
@@ -91,7 +161,14 @@ def get_col_text(col) -> str:
     return col_text
 
 
-def get_infobox_from_html(html: str) -> dict:
+def get_col_text(col) -> str:
+    return clean_col_text(col.text)
+
+
+def get_infobox_from_html_bs4(html: str) -> dict:
+    """The original BeautifulSoup implementation of get_infobox_from_html.
+    Kept so the two can be compared, see benchmark_infobox"""
+    from bs4 import BeautifulSoup
     assert isinstance(html, str)
     soup = BeautifulSoup(html, "lxml")
     assert soup is not None
@@ -111,6 +188,76 @@ def get_infobox_from_html(html: str) -> dict:
     return d
 
 
+# the first table which has 'infobox' as one of its classes
+INFOBOX_XPATH = "//table[contains(concat(' ', normalize-space(@class), ' '), ' infobox ')][1]"
+
+
+def _first_descendant(elem, tag: str):
+    return next(elem.iter(tag), None)
+
+
+def get_infobox_from_html(html: str) -> dict:
+    """
+    Read the infobox from the article into a map from row header to row contents.
+    The first row, which has no header, is the title.
+
+    Same output as get_infobox_from_html_bs4 (text of comments is ignored, as with BeautifulSoup 4.6),
+    but uses lxml directly and only walks the infobox table.
+    On ~500KB articles generated by synthetic_corpus.py this was 20x faster (0.025s vs 0.5s per article).
+    That is not a measurement on real Wikipedia pages. To measure on the articles in the wiki cache,
+    run `python book_classics/ru_wiki.py --benchmark-infobox`.
+    """
+    import lxml.html
+    assert isinstance(html, str)
+    doc = lxml.html.document_fromstring(html)
+    table = doc.xpath(INFOBOX_XPATH)[0]
+    d = {}
+    for i, row in enumerate(table.iter("tr")):
+        header = _first_descendant(row, "th")
+        if header is not None:
+            header_text = header.text_content().strip().rstrip(":")
+            col = _first_descendant(row, "td")
+            d[header_text] = clean_col_text(col.text_content())
+        elif i == 0:
+            col = _first_descendant(row, "td")
+            d["title"] = clean_col_text(col.text_content())
+        else:
+            continue
+    return d
+
+
+def benchmark_infobox(fnames: List[str]) -> dict:
+    """Compare get_infobox_from_html against get_infobox_from_html_bs4 on the given HTML files
+    :return:        timings, and the files where the two disagree"""
+    bs4_time = 0.0
+    lxml_time = 0.0
+    mismatches = []
+    for fname in fnames:
+        html = read_html(fname)
+        start = time.perf_counter()
+        try:
+            expected = get_infobox_from_html_bs4(html)
+        except IndexError:
+            # no infobox
+            expected = None
+        bs4_time += time.perf_counter() - start
+        start = time.perf_counter()
+        try:
+            actual = get_infobox_from_html(html)
+        except IndexError:
+            actual = None
+        lxml_time += time.perf_counter() - start
+        if actual != expected:
+            mismatches.append(fname)
+    return {
+        "num_files": len(fnames),
+        "bs4_seconds": bs4_time,
+        "lxml_seconds": lxml_time,
+        "speedup": bs4_time / lxml_time if lxml_time > 0 else None,
+        "mismatches": mismatches,
+    }
+
+
 def book_from_infobox(infobox: dict, search_str: str) -> Book:
     str_distance = Levenshtein.distance(infobox["title"], search_str)
     return Book(
@@ -123,68 +270,233 @@ def book_from_infobox(infobox: dict, search_str: str) -> Book:
 
 def search_wikipedia_helper(search: str):
     """Seach using the wikipedia python bindings"""
+    import wptools
     parsed_page = wptools.page(search).get_query()
     pprint(parsed_page)
     # infobox = parsed_page.infobox
     # pprint(infobox)
 
 
+class _WikiCacheUnpickler(pickle.Unpickler):
+    """The old cache was pickled from whichever module ran it, usually __main__"""
+
+    def find_class(self, module: str, name: str):
+        if name == "WikiCache":
+            return WikiCache
+        return super().find_class(module, name)
+
+
 class WikiCache:
+    """
+    Map from search string to the Wikipedia page it found.
+    Pages are stored compressed under their content hash (see save_html), along with the infobox parsed out of them,
+    so a repeat search doesn't need to parse any HTML.
+    """
     FNAME = "data/wiki-cache.dat"
+    VERSION = 2
 
-    def __init__(self):
-        self.cache = {}
+    def __init__(self) -> None:
+        # map from search string to {"page_title", "content_hash"}
+        self.searches: Dict[str, dict] = {}
+        # map from content hash to the infobox on that page, None if there is none
+        self.infoboxes: Dict[str, Optional[dict]] = {}
 
     @staticmethod
     def load() -> "WikiCache":
         with open(WikiCache.FNAME, "rb") as fp:
-            return pickle.load(fp)
+            state = _WikiCacheUnpickler(fp).load()
+        if isinstance(state, WikiCache):
+            # the old cache pickled itself, and pointed each search at a randomly named HTML file
+            wiki_cache = WikiCache.from_legacy(state.__dict__["cache"])
+            wiki_cache.save()
+            return wiki_cache
+        if state.get("version") != WikiCache.VERSION:
+            raise IOError("Unknown wiki cache version {}".format(state.get("version")))
+        wiki_cache = WikiCache()
+        wiki_cache.searches = state["searches"]
+        wiki_cache.infoboxes = state["infoboxes"]
+        return wiki_cache
+
+    @staticmethod
+    def from_legacy(legacy_cache: Dict[str, dict]) -> "WikiCache":
+        wiki_cache = WikiCache()
+        for search_str, entry in legacy_cache.items():
+            if "html_file" not in entry or not os.path.exists(entry["html_file"]):
+                logging.warning("Dropping '%s' from the wiki cache, its HTML file is missing", search_str)
+                continue
+            wiki_cache.set_page(search_str, entry.get("page_title"), read_html(entry["html_file"]))
+        logging.info("Migrated %d searches in the wiki cache. Run with --gc to remove the old HTML files.",
+                     len(wiki_cache.searches))
+        return wiki_cache
 
     def save(self) -> None:
-        with open(WikiCache.FNAME, "wb") as fp:
-            pickle.dump(self, fp)
+        # write to a temp file then move so an interrupted save never leaves a partial cache
+        tmp_fname = WikiCache.FNAME + ".tmp"
+        with open(tmp_fname, "wb") as fp:
+            pickle.dump({
+                "version": WikiCache.VERSION,
+                "searches": self.searches,
+                "infoboxes": self.infoboxes,
+            }, fp)
+        os.replace(tmp_fname, WikiCache.FNAME)
 
     def __contains__(self, search_str: str) -> bool:
-        return search_str in self.cache
-
-    def set_page_title(self, search_str: str, page_title: str) -> None:
-        if search_str not in self.cache:
-            self.cache[search_str] = {}
-        self.cache[search_str]["page_title"] = page_title
-
-    def set_html_filename(self, search_str: str, fname: str) -> None:
-        if search_str not in self.cache:
-            self.cache[search_str] = {}
-        self.cache[search_str]["html_file"] = fname
-
-    def get_html_filename(self, search_str: str) -> str:
-        return self.cache[search_str]["html_file"]
+        return search_str in self.searches
+
+    def set_page(self, search_str: str, page_title: str, html: str) -> None:
+        content_hash = save_html(html)
+        if content_hash not in self.infoboxes:
+            with profiler.span("parse.wiki_html"):
+                try:
+                    self.infoboxes[content_hash] = get_infobox_from_html(html)
+                except IndexError:
+                    self.infoboxes[content_hash] = None
+        self.searches[search_str] = {
+            "page_title": page_title,
+            "content_hash": content_hash,
+        }
+
+    def get_page_title(self, search_str: str) -> str:
+        return self.searches[search_str]["page_title"]
+
+    def get_html(self, search_str: str) -> str:
+        return read_html(get_html_fname(self.searches[search_str]["content_hash"]))
+
+    def get_infobox(self, search_str: str) -> Optional[dict]:
+        """:return: None if the page has no infobox"""
+        return self.infoboxes[self.searches[search_str]["content_hash"]]
+
+    def gc(self) -> List[str]:
+        """Delete the HTML files which no search refers to
+        :return:        The deleted files"""
+        referenced = set(get_html_fname(entry["content_hash"]) for entry in self.searches.values())
+        deleted = []
+        # only pages, as saved by save_html or by the old cache, never anything else in the directory
+        fnames = (glob.glob(os.path.join(WIKI_HTML_CACHE_DIR, "*.html.gz")) +
+                  glob.glob(os.path.join(WIKI_HTML_CACHE_DIR, "*.html")))
+        for fname in fnames:
+            if fname not in referenced:
+                os.remove(fname)
+                deleted.append(fname)
+        # drop the infoboxes of deleted pages too
+        referenced_hashes = set(entry["content_hash"] for entry in self.searches.values())
+        self.infoboxes = {h: infobox for h, infobox in self.infoboxes.items() if h in referenced_hashes}
+        return deleted
+
+
+def get_book(search_str: str, wiki_cache: WikiCache) -> Book:
+    """Find the book on Wikipedia, going to the network only if it isn't in the cache.
+    Doesn't save the cache."""
+    if search_str not in wiki_cache:
+        profiler.count("wiki_cache.miss")
+        data = search_wikipedia_curl(search_str)
+        page_title = get_page_title(data)
+        html = search_for_html_page(page_title)
+        wiki_cache.set_page(search_str, page_title, html)
+    else:
+        logging.debug("Loading infobox from cache...")
+        profiler.count("wiki_cache.hit")
+    return get_cached_book(search_str, wiki_cache)
+
+
+def get_cached_book(search_str: str, wiki_cache: WikiCache) -> Book:
+    infobox = wiki_cache.get_infobox(search_str)
+    if infobox is None:
+        raise IndexError("No infobox on the page for '{}'".format(search_str))
+    return book_from_infobox(infobox, search_str)
+
+
+def get_titles_from_file(fname: str) -> Iterator[str]:
+    with open(fname) as fp:
+        for line in fp:
+            if line.startswith("# "):
+                # consider these comments
+                continue
+            line = line.strip()
+            if line == "":
+                continue
+            yield line
+
+
+def fetch_pages(searches: List[str], wiki_cache: WikiCache, jobs: int = DEFAULT_FETCH_JOBS) -> int:
+    """Add all the searches which aren't cached yet to the cache.
+    Page titles are looked up MAX_TITLES_PER_QUERY at a time, then the pages are fetched concurrently.
+    Doesn't save the cache.
+    :return:        The number of pages fetched"""
+    uncached = [search_str for search_str in dict.fromkeys(searches) if search_str not in wiki_cache]
+    profiler.count("wiki_cache.hit", len(set(searches)) - len(uncached))
+    profiler.count("wiki_cache.miss", len(uncached))
+    page_titles: Dict[str, str] = {}
+    for i in range(0, len(uncached), MAX_TITLES_PER_QUERY):
+        page_titles.update(search_wikipedia_titles(uncached[i:i + MAX_TITLES_PER_QUERY]))
+    logging.info("Found %d of %d uncached pages in %d queries", len(page_titles), len(uncached),
+                 (len(uncached) + MAX_TITLES_PER_QUERY - 1) // MAX_TITLES_PER_QUERY)
+    # several searches may lead to the same page
+    unique_titles = sorted(set(page_titles.values()))
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pages = dict(zip(unique_titles, executor.map(search_for_html_page, unique_titles)))
+    for search_str, page_title in page_titles.items():
+        wiki_cache.set_page(search_str, page_title, pages[page_title])
+    return len(unique_titles)
+
+
+def get_books(searches: List[str], wiki_cache: WikiCache, jobs: int = DEFAULT_FETCH_JOBS) -> Dict[str, Optional[Book]]:
+    """Find many books on Wikipedia at once. Doesn't save the cache.
+    :return:        map from search to the book, or None if it could not be found"""
+    fetch_pages(searches, wiki_cache, jobs=jobs)
+    books: Dict[str, Optional[Book]] = {}
+    for search_str in searches:
+        if search_str not in wiki_cache:
+            books[search_str] = None
+            continue
+        try:
+            books[search_str] = get_cached_book(search_str, wiki_cache)
+        except (IndexError, KeyError):
+            logging.warning("No book infobox on the page for '%s'", search_str)
+            books[search_str] = None
+    return books
 
 
 if __name__ == "__main__":
-    setup_logging()
     parser = ArgumentParser()
-    parser.add_argument("search_str")
+    parser.add_argument("search_str", nargs="?")
+    parser.add_argument("-f", "--batch-file",
+                        help="Resolve every title in this file, one per line, instead of search_str")
+    parser.add_argument("-j", "--jobs", type=int, default=DEFAULT_FETCH_JOBS,
+                        help="Number of pages to fetch at once in batch mode")
+    parser.add_argument("--benchmark-infobox", action="store_true", default=False,
+                        help="Compare the lxml and BeautifulSoup infobox parsers on the cached articles")
+    parser.add_argument("--gc", action="store_true", default=False,
+                        help="Delete cached HTML files which no search refers to")
+    add_profile_argument(parser)
     args = parser.parse_args()
+    setup_logging(profile=args.profile)
+    if args.benchmark_infobox:
+        pprint(benchmark_infobox(glob.glob(os.path.join(WIKI_HTML_CACHE_DIR, "*.html*"))))
+        raise SystemExit()
+    if args.search_str is None and args.batch_file is None and not args.gc:
+        parser.error("one of search_str, --batch-file or --gc is required")
+    if args.gc:
+        # without the searches to go by, every HTML file would look orphaned
+        try:
+            wiki_cache = WikiCache.load()
+        except IOError as e:
+            raise SystemExit("Not deleting anything, could not load the wiki cache: {}".format(e))
+        deleted = wiki_cache.gc()
+        wiki_cache.save()
+        logging.info("Deleted %d orphaned HTML files", len(deleted))
+        raise SystemExit()
     try:
         wiki_cache = WikiCache.load()
-    except IOError:
+    except FileNotFoundError:
+        # any other error, e.g. an unknown version, is raised so the unreadable cache isn't saved over
         wiki_cache = WikiCache()
-    search_str = args.search_str
-    if search_str in wiki_cache:
-        logging.debug("Loading page from cache...")
-        fname = wiki_cache.get_html_filename(search_str)
-        logging.debug("Reading HTML from file '%s'..." % fname)
-        html = read_html(fname)
+    if args.batch_file:
+        books = get_books(list(get_titles_from_file(args.batch_file)), wiki_cache, jobs=args.jobs)
+        wiki_cache.save()
+        for search_str, book in books.items():
+            print("{} -> {}".format(search_str, book))
     else:
-        data = search_wikipedia_curl(search_str)
-        page_title = get_page_title(data)
-        wiki_cache.set_page_title(search_str, page_title)
-        html = search_for_html_page(page_title)
-        fname = save_html(html)
-        wiki_cache.set_html_filename(search_str, fname)
+        book = get_book(args.search_str, wiki_cache)
         wiki_cache.save()
-    assert isinstance(html, str)
-    infobox = get_infobox_from_html(html)
-    book = book_from_infobox(infobox, search_str)
-    print(book)
+        print(book)
@@ -0,0 +1,173 @@
+"""
+Single-file store for raw Goodreads search responses.
+
+Responses are zlib-compressed and kept in one SQLite database, keyed on the normalized query.
+The candidates parsed out of each response are kept alongside, so a cache hit never needs to parse XML.
+Each response also records when it was fetched, and its ETag if Goodreads sent one,
+so stale responses can be revalidated.
+This replaces the old directory of one XML file per query (GOODREADS_CACHE_DIR).
+To import that directory into the store, run:
+
+    python book_classics/search_cache.py migrate
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import time
+import zlib
+from argparse import ArgumentParser
+from collections import namedtuple
+from typing import List, Optional
+
+from log_utils import setup_logging
+
+# the old one-file-per-query cache
+GOODREADS_CACHE_DIR = "data/goodreads-cache"
+
+
+# one result of a Goodreads search
+SearchCandidate = namedtuple("SearchCandidate", [
+    "goodreads_id",
+    "title",
+    "author",
+    "num_ratings",
+    "original_publication_year",
+])
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.lower().split())
+
+
+class GoodreadsSearchCache:
+    FNAME = "data/goodreads-cache.db"
+    # how long to wait for another resolver to release its lock on the cache, in seconds
+    LOCK_TIMEOUT = 60
+
+    def __init__(self, fname: Optional[str] = None) -> None:
+        self.fname = fname or GoodreadsSearchCache.FNAME
+        dirname = os.path.dirname(self.fname)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.conn = sqlite3.connect(self.fname, timeout=GoodreadsSearchCache.LOCK_TIMEOUT)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS search_results (
+            query TEXT PRIMARY KEY,
+            xml BLOB NOT NULL,
+            fetched_at REAL,
+            etag TEXT
+        )""")
+        # caches created before responses had timestamps
+        columns = set(row[1] for row in self.conn.execute("PRAGMA table_info(search_results)"))
+        for column, column_type in [("fetched_at", "REAL"), ("etag", "TEXT")]:
+            if column not in columns:
+                self.conn.execute("ALTER TABLE search_results ADD COLUMN {} {}".format(column, column_type))
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS search_candidates (
+            query TEXT PRIMARY KEY,
+            candidates TEXT NOT NULL
+        )""")
+        self.conn.commit()
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __contains__(self, query: str) -> bool:
+        row = self.conn.execute("SELECT 1 FROM search_results WHERE query = ?",
+                                (normalize_query(query),)).fetchone()
+        return row is not None
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM search_results").fetchone()[0]
+
+    def get(self, query: str) -> Optional[str]:
+        """:return: The raw XML response for the query, or None on a cache miss"""
+        row = self.conn.execute("SELECT xml FROM search_results WHERE query = ?",
+                                (normalize_query(query),)).fetchone()
+        if row is None:
+            return None
+        return zlib.decompress(row[0]).decode("utf-8")
+
+    def get_fetched_at(self, query: str) -> Optional[float]:
+        """:return: When the response to the query was fetched, as a Unix timestamp.
+                    0 if that isn't known, and None on a cache miss."""
+        row = self.conn.execute("SELECT fetched_at FROM search_results WHERE query = ?",
+                                (normalize_query(query),)).fetchone()
+        if row is None:
+            return None
+        return row[0] or 0.0
+
+    def get_etag(self, query: str) -> Optional[str]:
+        row = self.conn.execute("SELECT etag FROM search_results WHERE query = ?",
+                                (normalize_query(query),)).fetchone()
+        return row[0] if row is not None else None
+
+    def touch(self, query: str) -> None:
+        """The cached response is still current"""
+        with self.conn:
+            self.conn.execute("UPDATE search_results SET fetched_at = ? WHERE query = ?",
+                              (time.time(), normalize_query(query)))
+
+    def put(self, query: str, xml: str, commit: bool = True, etag: Optional[str] = None,
+            fetched_at: Optional[float] = None) -> None:
+        """
+        :param fetched_at:      Defaults to now
+        """
+        normalized_query = normalize_query(query)
+        self.conn.execute("INSERT OR REPLACE INTO search_results (query, xml, fetched_at, etag) VALUES (?, ?, ?, ?)",
+                          (normalized_query, zlib.compress(xml.encode("utf-8")),
+                           time.time() if fetched_at is None else fetched_at, etag))
+        # the candidates parsed from the old response are now stale
+        self.conn.execute("DELETE FROM search_candidates WHERE query = ?", (normalized_query,))
+        if commit:
+            self.conn.commit()
+
+    def get_candidates(self, query: str) -> Optional[List[SearchCandidate]]:
+        """:return: The candidates parsed from the response to the query, or None if they aren't cached"""
+        row = self.conn.execute("SELECT candidates FROM search_candidates WHERE query = ?",
+                                (normalize_query(query),)).fetchone()
+        if row is None:
+            return None
+        return [SearchCandidate(*candidate) for candidate in json.loads(row[0])]
+
+    def put_candidates(self, query: str, candidates: List[SearchCandidate]) -> None:
+        self.conn.execute("INSERT OR REPLACE INTO search_candidates (query, candidates) VALUES (?, ?)",
+                          (normalize_query(query), json.dumps([list(candidate) for candidate in candidates])))
+        self.conn.commit()
+
+    def migrate_directory(self, dirname: str = GOODREADS_CACHE_DIR) -> int:
+        """Import every XML file from the old one-file-per-query cache directory
+        Existing entries in the store are not overwritten
+        :return:        The number of responses imported"""
+        num_imported = 0
+        for fname in sorted(os.listdir(dirname)):
+            if not fname.endswith(".xml"):
+                continue
+            # the old cache file name was the query, lowercased, with spaces replaced by underscores
+            query = os.path.splitext(fname)[0].replace("_", " ")
+            if query in self:
+                continue
+            with open(os.path.join(dirname, fname)) as fp:
+                self.put(query, fp.read(), commit=False, fetched_at=os.path.getmtime(os.path.join(dirname, fname)))
+            num_imported += 1
+        self.conn.commit()
+        return num_imported
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    migrate_parser = subparsers.add_parser("migrate", help="Import the old Goodreads XML cache directory")
+    migrate_parser.add_argument("--dir", default=GOODREADS_CACHE_DIR,
+                                help="The old cache directory, one XML file per query")
+    args = parser.parse_args()
+    setup_logging()
+    if args.command == "migrate":
+        cache = GoodreadsSearchCache()
+        num_imported = cache.migrate_directory(args.dir)
+        logging.info("Imported %d responses from %s into %s, which now has %d responses",
+                     num_imported, args.dir, cache.fname, len(cache))
+        cache.close()
+    else:
+        parser.print_help()
@@ -0,0 +1,309 @@
+"""
+Each person's nearest neighbours by the picks they share with everyone else.
+
+Similarity between two people is either
+- jaccard: (# books both picked) / (# books either picked)
+- overlap: # books both picked
+
+Exact mode multiplies a chunk of rows of the person x book incidence matrix by its transpose,
+which gives the number of shared picks with everyone, and keeps the top k of each row.
+Chunks are sized so that the product and the arrays derived from it stay under a memory cap.
+
+Approximate mode uses MinHash signatures and locality-sensitive hashing (LSH) to find candidate pairs,
+which are likely to have a high Jaccard similarity, and scores only those exactly.
+Neighbours which share few picks relative to how many they picked can be missed.
+
+Neighbours are written chunk by chunk to a CSV file:
+
+    python book_classics/similarity.py -k 10 --metric jaccard --approximate
+"""
+
+import csv
+import logging
+import os
+from argparse import ArgumentParser
+from collections import namedtuple
+from typing import TYPE_CHECKING, Iterator, List, Tuple
+
+import numpy as np
+
+from dataset import load_dataset
+from incidence import PersonBookIncidence
+from log_utils import add_profile_argument, profiler, setup_logging
+
+if TYPE_CHECKING:
+    from scipy import sparse
+
+JACCARD = "jaccard"
+OVERLAP = "overlap"
+METRICS = [JACCARD, OVERLAP]
+
+NEIGHBOURS_FNAME = "data/neighbours.csv"
+DEFAULT_NUM_NEIGHBOURS = 10
+DEFAULT_MAX_MEMORY_MB = 256
+# rough number of bytes used per scored pair of people: the product entry, its coordinates, scores and sort order
+BYTES_PER_PAIR = 64
+# bytes used per pick when gathering the rows of candidate pairs in approximate mode,
+# for the indices and data of the gathered rows and of their product
+BYTES_PER_PICK = 24
+
+DEFAULT_NUM_HASHES = 64
+DEFAULT_ROWS_PER_BAND = 2
+# people in an LSH bucket beyond this many are not made candidates of each other,
+# since a bucket of people who all picked the same one classic would otherwise make every pair a candidate
+DEFAULT_MAX_BUCKET_SIZE = 200
+# a Mersenne prime, larger than any number of books
+MINHASH_PRIME = (1 << 31) - 1
+
+
+# the top k neighbours of a chunk of people, as parallel arrays sorted by person then rank
+# people and neighbours are rows of the incidence matrix, and ranks start at 1
+Neighbours = namedtuple("Neighbours", ["people", "ranks", "neighbours", "shared", "scores"])
+
+
+def get_binary_matrix(incidence: PersonBookIncidence) -> "sparse.csr_matrix":
+    """The incidence matrix with every selection counted once"""
+    from scipy import sparse
+    matrix = incidence.matrix.tocsr()
+    matrix.sum_duplicates()
+    return sparse.csr_matrix((np.ones(len(matrix.data), dtype=np.int32), matrix.indices, matrix.indptr),
+                             shape=matrix.shape)
+
+
+def get_chunks(costs: np.ndarray, max_cost: float) -> Iterator[Tuple[int, int]]:
+    """Split rows into contiguous chunks whose costs add up to at most max_cost
+    A row which costs more than max_cost on its own gets a chunk to itself
+    :return:        (start, end) of each chunk"""
+    start = 0
+    num_rows = len(costs)
+    cumulative = np.cumsum(costs, dtype=np.float64)
+    while start < num_rows:
+        offset = cumulative[start - 1] if start > 0 else 0.0
+        end = int(np.searchsorted(cumulative, offset + max_cost, side="right"))
+        end = max(end, start + 1)
+        yield start, end
+        start = end
+
+
+def get_scores(shared: np.ndarray, sizes_a: np.ndarray, sizes_b: np.ndarray, metric: str) -> np.ndarray:
+    """
+    :param shared:      Number of books picked by both people of each pair
+    :param sizes_a:     Number of books picked by the first person of each pair
+    :param sizes_b:     Number of books picked by the second person of each pair
+    """
+    if metric == OVERLAP:
+        return shared.astype(np.float64)
+    assert metric == JACCARD
+    return shared / (sizes_a + sizes_b - shared).astype(np.float64)
+
+
+def get_ranges(starts: np.ndarray, sizes: np.ndarray) -> np.ndarray:
+    """:return:     The concatenation of range(start, start + size) for each start and size"""
+    offsets = np.arange(int(sizes.sum())) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    return np.repeat(starts, sizes) + offsets
+
+
+def get_ranks(sorted_rows: np.ndarray) -> np.ndarray:
+    """:return:     Rank of each entry among the entries of its row, starting at 1"""
+    is_first = np.ones(len(sorted_rows), dtype=bool)
+    is_first[1:] = sorted_rows[1:] != sorted_rows[:-1]
+    first_indices = np.flatnonzero(is_first)
+    group_sizes = np.diff(np.append(first_indices, len(sorted_rows)))
+    return np.arange(len(sorted_rows)) - np.repeat(first_indices, group_sizes) + 1
+
+
+def get_top_k(rows: np.ndarray, cols: np.ndarray, shared: np.ndarray, sizes: np.ndarray,
+              k: int, metric: str) -> Neighbours:
+    """Keep the k best pairs of each row
+    Ties are broken by the other metric, then by the lower row index, so results are deterministic
+    :param rows:        Sorted
+    :param sizes:       Number of books picked by each person"""
+    scores = get_scores(shared, sizes[rows], sizes[cols], metric)
+    # sorting on every key is slow, so first find the kth best score of each row by sorting on score alone,
+    # and drop the pairs which score below it. Rows with fewer than k pairs keep them all.
+    positions = get_ranks(rows) - 1
+    if len(rows) > 0 and positions.max() >= k:
+        local_rows = np.cumsum(positions == 0) - 1
+        by_score = np.lexsort((-scores, rows))
+        is_kth = positions == k - 1
+        kth_scores = np.full(local_rows[-1] + 1, -np.inf)
+        kth_scores[local_rows[is_kth]] = scores[by_score[is_kth]]
+        keep = np.flatnonzero(scores >= kth_scores[local_rows])
+        rows, cols, shared, scores = rows[keep], cols[keep], shared[keep], scores[keep]
+    other_scores = get_scores(shared, sizes[rows], sizes[cols], OVERLAP if metric == JACCARD else JACCARD)
+    order = np.lexsort((cols, -other_scores, -scores, rows))
+    rows = rows[order]
+    ranks = get_ranks(rows)
+    keep = ranks <= k
+    order = order[keep]
+    return Neighbours(rows[keep], ranks[keep], cols[order], shared[order], scores[order])
+
+
+def iter_exact_neighbours(incidence: PersonBookIncidence, k: int = DEFAULT_NUM_NEIGHBOURS, metric: str = JACCARD,
+                          max_memory_bytes: int = DEFAULT_MAX_MEMORY_MB << 20) -> Iterator[Neighbours]:
+    """Top k neighbours of everyone, by sparse products of chunks of rows with the whole matrix"""
+    matrix = get_binary_matrix(incidence)
+    transposed = matrix.T.tocsr()
+    sizes = np.asarray(matrix.sum(axis=1)).ravel()
+    # the product has at most as many entries in a row as people who picked any of that row's books
+    popularity = np.asarray(matrix.sum(axis=0)).ravel()
+    max_pairs = matrix.dot(popularity)
+    for start, end in get_chunks(max_pairs * BYTES_PER_PAIR, max_memory_bytes):
+        with profiler.span("similarity.exact.chunk"):
+            product = matrix[start:end].dot(transposed).tocoo()
+            rows = product.row.astype(np.int64) + start
+            cols = product.col.astype(np.int64)
+            not_self = rows != cols
+            profiler.count("similarity.pairs", int(not_self.sum()))
+            yield get_top_k(rows[not_self], cols[not_self], product.data[not_self], sizes, k, metric)
+
+
+def get_minhash_signatures(matrix: "sparse.csr_matrix", num_hashes: int = DEFAULT_NUM_HASHES,
+                           max_memory_bytes: int = DEFAULT_MAX_MEMORY_MB << 20, seed: int = 0) -> np.ndarray:
+    """
+    :param matrix:      Binary person x book matrix
+    :return:            Array of shape (people, num_hashes). The jth column is the smallest value of the jth hash
+                        over each person's books, so two people agree on it with probability equal to their Jaccard
+                        similarity.
+    """
+    assert matrix.shape[1] < MINHASH_PRIME
+    rng = np.random.default_rng(seed)
+    # the hashes are (a * book + b) mod p, which don't collide since p is prime and larger than any book index
+    a = rng.integers(1, MINHASH_PRIME, size=num_hashes, dtype=np.int64)
+    b = rng.integers(0, MINHASH_PRIME, size=num_hashes, dtype=np.int64)
+    signatures = np.full((matrix.shape[0], num_hashes), MINHASH_PRIME, dtype=np.uint32)
+    # each pick of a chunk has a temporary int64 hash per hash function
+    picks_per_row = np.diff(matrix.indptr)
+    for start, end in get_chunks(picks_per_row * num_hashes * 16, max_memory_bytes):
+        chunk = matrix[start:end]
+        if chunk.nnz == 0:
+            continue
+        hashes = (chunk.indices.astype(np.int64)[:, None] * a[None, :] + b[None, :]) % MINHASH_PRIME
+        # reduceat needs the offsets of non-empty rows only
+        non_empty = np.flatnonzero(np.diff(chunk.indptr))
+        signatures[start + non_empty] = np.minimum.reduceat(hashes, chunk.indptr[non_empty], axis=0)
+    return signatures
+
+
+class LSHIndex:
+    """People bucketed by bands of their MinHash signatures
+    Two people with Jaccard similarity s share at least one bucket with probability 1 - (1 - s^r)^b,
+    where r is the number of rows per band and b the number of bands"""
+
+    def __init__(self, signatures: np.ndarray, rows_per_band: int = DEFAULT_ROWS_PER_BAND,
+                 max_bucket_size: int = DEFAULT_MAX_BUCKET_SIZE) -> None:
+        num_people, num_hashes = signatures.shape
+        assert num_hashes % rows_per_band == 0
+        self.num_people = num_people
+        self.max_bucket_size = max_bucket_size
+        # for each band: the bucket of each person, people sorted by bucket, and the start and size of each bucket
+        self.buckets: List[np.ndarray] = []
+        self.members: List[np.ndarray] = []
+        self.starts: List[np.ndarray] = []
+        self.counts: List[np.ndarray] = []
+        for band_start in range(0, num_hashes, rows_per_band):
+            band = np.ascontiguousarray(signatures[:, band_start:band_start + rows_per_band])
+            _, buckets, counts = np.unique(band, axis=0, return_inverse=True, return_counts=True)
+            buckets = buckets.ravel().astype(np.int32)
+            self.buckets.append(buckets)
+            self.members.append(np.argsort(buckets, kind="stable").astype(np.int32))
+            self.starts.append((np.cumsum(counts) - counts).astype(np.int64))
+            self.counts.append(np.minimum(counts, max_bucket_size).astype(np.int64))
+
+    def get_num_candidates(self) -> np.ndarray:
+        """:return:     Upper bound of the number of candidates of each person"""
+        return sum(counts[buckets] for buckets, counts in zip(self.buckets, self.counts))
+
+    def get_candidate_pairs(self, start: int, end: int) -> Tuple[np.ndarray, np.ndarray]:
+        """:return:     (rows, cols) of each distinct candidate pair, for the people in rows start to end"""
+        rows = np.arange(start, end, dtype=np.int64)
+        pairs = []
+        for buckets, members, starts, counts in zip(self.buckets, self.members, self.starts, self.counts):
+            person_buckets = buckets[start:end]
+            sizes = counts[person_buckets]
+            cols = members[get_ranges(starts[person_buckets], sizes)]
+            pairs.append(np.repeat(rows, sizes) * self.num_people + cols)
+        # each pair as a single integer, so duplicates from several bands can be dropped
+        pairs = np.sort(np.concatenate(pairs))
+        pairs = pairs[np.diff(pairs, prepend=-1) != 0]
+        rows, cols = np.divmod(pairs, self.num_people)
+        not_self = rows != cols
+        return rows[not_self], cols[not_self]
+
+
+def iter_approximate_neighbours(incidence: PersonBookIncidence, k: int = DEFAULT_NUM_NEIGHBOURS,
+                                metric: str = JACCARD, max_memory_bytes: int = DEFAULT_MAX_MEMORY_MB << 20,
+                                num_hashes: int = DEFAULT_NUM_HASHES, rows_per_band: int = DEFAULT_ROWS_PER_BAND,
+                                max_bucket_size: int = DEFAULT_MAX_BUCKET_SIZE,
+                                seed: int = 0) -> Iterator[Neighbours]:
+    """Top k neighbours of everyone among the candidates found by MinHash LSH.
+    Candidates are scored exactly, so every neighbour found is a real one, but some may be missed."""
+    matrix = get_binary_matrix(incidence)
+    sizes = np.asarray(matrix.sum(axis=1)).ravel()
+    with profiler.span("similarity.minhash"):
+        signatures = get_minhash_signatures(matrix, num_hashes, max_memory_bytes, seed)
+    with profiler.span("similarity.lsh_index"):
+        index = LSHIndex(signatures, rows_per_band, max_bucket_size)
+    # gathering the picks of both people in a pair dominates, so assume the other person picked the average number
+    pair_cost = BYTES_PER_PAIR + (sizes + sizes.mean()) * BYTES_PER_PICK
+    for start, end in get_chunks(index.get_num_candidates() * pair_cost, max_memory_bytes):
+        with profiler.span("similarity.approximate.chunk"):
+            rows, cols = index.get_candidate_pairs(start, end)
+            profiler.count("similarity.candidate_pairs", len(rows))
+            shared = np.asarray(matrix[rows].multiply(matrix[cols]).sum(axis=1)).ravel()
+            # people who agree on a MinHash value share a book, but be safe
+            is_shared = shared > 0
+            yield get_top_k(rows[is_shared], cols[is_shared], shared[is_shared], sizes, k, metric)
+
+
+def write_neighbours(people: List[str], chunks: Iterator[Neighbours], fname: str = NEIGHBOURS_FNAME) -> int:
+    """Write neighbours as they are computed. The file is only replaced once every chunk has been written.
+    :param people:      Name of each row of the incidence matrix
+    :return:            The number of neighbours written"""
+    dirname = os.path.dirname(fname)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    tmp_fname = fname + ".tmp"
+    num_written = 0
+    with open(tmp_fname, "w") as fp:
+        writer = csv.writer(fp, quotechar='"', delimiter=',')
+        writer.writerow(["person", "rank", "neighbour", "shared_books", "similarity"])
+        for chunk in chunks:
+            for row, rank, col, shared, score in zip(chunk.people.tolist(), chunk.ranks.tolist(),
+                                                     chunk.neighbours.tolist(), chunk.shared.tolist(),
+                                                     chunk.scores.tolist()):
+                writer.writerow([people[row], rank, people[col], shared, "{:.4f}".format(score)])
+            num_written += len(chunk.people)
+    os.replace(tmp_fname, fname)
+    return num_written
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-k", type=int, default=DEFAULT_NUM_NEIGHBOURS, help="Number of neighbours per person")
+    parser.add_argument("--metric", choices=METRICS, default=JACCARD)
+    parser.add_argument("--approximate", action="store_true",
+                        help="Only score candidate pairs found by MinHash LSH. Faster for many people, "
+                             "but may miss neighbours.")
+    parser.add_argument("--max-memory-mb", type=float, default=DEFAULT_MAX_MEMORY_MB,
+                        help="Roughly how much memory each chunk of people may use")
+    parser.add_argument("--num-hashes", type=int, default=DEFAULT_NUM_HASHES,
+                        help="Number of MinHash values per person in approximate mode")
+    parser.add_argument("--rows-per-band", type=int, default=DEFAULT_ROWS_PER_BAND,
+                        help="Number of MinHash values per LSH band. Fewer finds more distant neighbours.")
+    parser.add_argument("-o", "--out", default=NEIGHBOURS_FNAME)
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    if args.k < 1:
+        parser.error("-k must be at least 1")
+    setup_logging(verbose=False, profile=args.profile)
+    with profiler.span("similarity.load_dataset"):
+        incidence = load_dataset().get_incidence()
+    max_memory_bytes = int(args.max_memory_mb * (1 << 20))
+    if args.approximate:
+        chunks = iter_approximate_neighbours(incidence, args.k, args.metric, max_memory_bytes,
+                                             num_hashes=args.num_hashes, rows_per_band=args.rows_per_band)
+    else:
+        chunks = iter_exact_neighbours(incidence, args.k, args.metric, max_memory_bytes)
+    num_written = write_neighbours(incidence.people, chunks, args.out)
+    logging.info("Wrote %d neighbours of %d people to %s", num_written, len(incidence.people), args.out)
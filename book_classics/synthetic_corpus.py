@@ -0,0 +1,254 @@
+"""
+Generate a synthetic survey at a configurable scale, for benchmarking.
+
+Writes the same files the real pipeline reads:
+
+- data/raw-picks/$name.txt, one query per line, some with typos
+- data/resolved-picks/$name.csv
+- Goodreads search responses for the queries, in the Goodreads search cache
+- Russian Wikipedia articles with an infobox, in data/wikipedia-cache
+
+Book popularity follows a Zipf distribution, so a few classics are picked by many people
+and most books are picked by only one or two.
+"""
+
+import csv
+import logging
+import os
+import random
+from argparse import ArgumentParser
+from typing import Dict, List, Optional
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+from log_utils import setup_logging
+from search_cache import GoodreadsSearchCache
+
+WORDS = [
+    "war", "peace", "crime", "punishment", "pride", "prejudice", "old", "man", "sea", "great", "gatsby",
+    "brave", "new", "world", "animal", "farm", "catcher", "rye", "mockingbird", "kill", "dead", "souls",
+    "brothers", "idiot", "master", "margarita", "heart", "darkness", "light", "august", "sound", "fury",
+    "grapes", "wrath", "invisible", "moby", "dick", "hundred", "years", "solitude", "sun", "also", "rises",
+    "farewell", "arms", "lord", "flies", "rings", "little", "women", "jane", "eyre", "wuthering", "heights",
+]
+SYLLABLES = [c + v for c in "bdgklmnprstvz" for v in "aeiou"]
+FIRST_NAMES = ["Leo", "Fyodor", "Jane", "Ernest", "George", "Virginia", "Mikhail", "Anton", "Harper", "Toni"]
+LAST_NAMES = ["Tolstoy", "Dostoevsky", "Austen", "Hemingway", "Orwell", "Woolf", "Bulgakov", "Chekhov", "Lee",
+              "Morrison", "Nabokov", "Faulkner", "Steinbeck", "Melville", "Bronte", "Dickens", "Gogol", "Pushkin"]
+
+
+def get_title(book_id: int) -> str:
+    """A title which is almost always unique to the book ID
+    Titles of different books are mostly far apart, as real ones are, since a made-up word is mixed in"""
+    rng = random.Random(book_id)
+    num_words = rng.randint(1, 3)
+    words = [rng.choice(WORDS) for _ in range(num_words)]
+    made_up_word = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+    words.insert(rng.randint(0, num_words), made_up_word)
+    return " ".join(words).capitalize()
+
+
+def get_author(book_id: int) -> str:
+    rng = random.Random(-book_id)
+    return "{} {}".format(rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES))
+
+
+def get_year(book_id: int) -> int:
+    return 1600 + (book_id * 7919) % 420
+
+
+def get_num_ratings(book_id: int, num_books: int) -> int:
+    """Popular books (low IDs) have many more ratings"""
+    return int(5000000 / (1 + book_id) ** 0.8 * (num_books / (num_books + book_id)))
+
+
+def add_typo(s: str, rng: random.Random) -> str:
+    i = rng.randrange(len(s))
+    return s[:i] + rng.choice("abcdefghijklmnopqrstuvwxyz") + s[i + 1:]
+
+
+def get_person_name(i: int) -> str:
+    return "person {}".format(i)
+
+
+def get_search_response(query: str, book_id: int, num_books: int, num_results: int = 20) -> str:
+    """A Goodreads search response for the query, where the right answer is book_id
+    and the rest are books with similar titles"""
+    rng = random.Random(query)
+    book_ids = [book_id] + [rng.randrange(num_books) for _ in range(num_results - 1)]
+    works = []
+    for result_id in book_ids:
+        title = get_title(result_id) if result_id != book_id or rng.random() < 0.5 else query.capitalize()
+        works.append("""<work>
+<id type="integer">{id}</id>
+<books_count type="integer">{books_count}</books_count>
+<ratings_count type="integer">{ratings_count}</ratings_count>
+<text_reviews_count type="integer">{text_reviews_count}</text_reviews_count>
+<original_publication_year type="integer">{year}</original_publication_year>
+<original_publication_month type="integer" nil="true"/>
+<original_publication_day type="integer" nil="true"/>
+<average_rating>3.9</average_rating>
+<best_book type="Book">
+<id type="integer">{book_id}</id>
+<title>{title}</title>
+<author>
+<id type="integer">{author_id}</id>
+<name>{author}</name>
+</author>
+<image_url>https://images.gr-assets.com/books/{book_id}m.jpg</image_url>
+<small_image_url>https://images.gr-assets.com/books/{book_id}s.jpg</small_image_url>
+</best_book>
+</work>""".format(
+            id=result_id,
+            books_count=rng.randint(1, 500),
+            ratings_count=get_num_ratings(result_id, num_books),
+            text_reviews_count=rng.randint(0, 10000),
+            year=get_year(result_id),
+            book_id=result_id + 1000000,
+            title=escape(title),
+            author_id=result_id % 9973,
+            author=escape(get_author(result_id)),
+        ))
+    return """<?xml version="1.0" encoding="UTF-8"?>
+<GoodreadsResponse>
+<Request><authentication>true</authentication><key><![CDATA[xxx]]></key><method><![CDATA[search_index]]></method></Request>
+<search>
+<query><![CDATA[{query}]]></query>
+<results-start>1</results-start>
+<results-end>{n}</results-end>
+<total-results>{n}</total-results>
+<source>Goodreads</source>
+<query-time-seconds>0.12</query-time-seconds>
+<results>
+{works}
+</results>
+</search>
+</GoodreadsResponse>""".format(query=query, n=len(works), works="\n".join(works))
+
+
+def get_wikipedia_article(title: str, author: str, year: int, num_paragraphs: int = 200) -> str:
+    """A Russian Wikipedia article for the book, with an infobox in the middle of a lot of text"""
+    rng = random.Random(title)
+    paragraphs = []
+    for _ in range(num_paragraphs):
+        paragraphs.append("<p>" + " ".join(
+            '<a href="/wiki/{w}" title="{w}">{w}</a> роман повесть'.format(w=rng.choice(WORDS))
+            for _ in range(30)) + "</p>")
+    rows = "\n".join('<tr><th scope="row">Поле {i}:</th><td><a href="#">Значение {i}</a>\n</td></tr>'.format(i=i)
+                     for i in range(15))
+    infobox = """<table class="infobox" data-name="Литературное произведение" style="width:22em">
+<tbody><tr><td colspan="2" class="infobox-above" style="font-size:125%">{title}</td></tr>
+<tr><td colspan="2" class="infobox-image"><img src="cover.jpg" width="220"/></td></tr>
+<tr><th scope="row">Автор</th><td><a href="/wiki/{author}">{author}</a></td></tr>
+<tr><th scope="row">Язык оригинала</th><td>русский</td></tr>
+<tr><th scope="row">Выпуск</th><td>{year}</td></tr>
+{rows}
+</tbody></table>""".format(title=escape(title), author=escape(author), year=year, rows=rows)
+    half = num_paragraphs // 2
+    return """<!DOCTYPE html><html lang="ru"><head><meta charset="UTF-8"/><title>{title}</title>
+<script>var wgPageName = "x";</script></head><body><div id="content"><h1>{title}</h1>
+<div class="mw-parser-output">{before}
+<table class="wikitable"><tr><th>a</th><td>b</td></tr></table>
+{infobox}
+{after}</div></div></body></html>""".format(
+        title=escape(title), before="\n".join(paragraphs[:half]), infobox=infobox,
+        after="\n".join(paragraphs[half:]))
+
+
+def generate_picks(num_people: int, num_books: int, picks_per_person: int = 30, zipf_exponent: float = 1.1,
+                   seed: int = 0) -> List[np.ndarray]:
+    """:return: The book IDs picked by each person"""
+    rng = np.random.default_rng(seed)
+    ranks = np.arange(1, num_books + 1, dtype=np.float64)
+    popularity = ranks ** -zipf_exponent
+    popularity /= popularity.sum()
+    # vary how many books each person picks
+    counts = np.clip(rng.poisson(picks_per_person, size=num_people), 1, num_books)
+    picks = rng.choice(num_books, size=int(counts.sum()), p=popularity)
+    people_picks = []
+    start = 0
+    for count in counts.tolist():
+        people_picks.append(np.unique(picks[start:start + count]))
+        start += count
+    return people_picks
+
+
+def write_corpus(out_dir: str, num_people: int, num_books: int, picks_per_person: int = 30,
+                 typo_rate: float = 0.05, zipf_exponent: float = 1.1, seed: int = 0,
+                 num_search_responses: Optional[int] = 1000, num_articles: int = 20) -> Dict[str, int]:
+    """
+    Write the synthetic survey into out_dir/data
+    :param typo_rate:               Fraction of raw picks which have a typo in them
+    :param num_search_responses:    How many Goodreads search responses to write, None for one per unique query
+    :param num_articles:            How many Wikipedia articles to write
+    :return:                        Counts of what was written
+    """
+    rng = random.Random(seed)
+    data_dir = os.path.join(out_dir, "data")
+    raw_dir = os.path.join(data_dir, "raw-picks")
+    resolved_dir = os.path.join(data_dir, "resolved-picks")
+    wiki_dir = os.path.join(data_dir, "wikipedia-cache")
+    for dirname in [raw_dir, resolved_dir, wiki_dir]:
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+    people_picks = generate_picks(num_people, num_books, picks_per_person, zipf_exponent, seed)
+    # map from query to the book it should resolve to
+    queries: Dict[str, int] = {}
+    num_picks = 0
+    for i, book_ids in enumerate(people_picks):
+        fname = get_person_name(i).replace(" ", "_")
+        with open(os.path.join(raw_dir, fname + ".txt"), "w") as raw_fp, \
+                open(os.path.join(resolved_dir, fname + ".csv"), "w") as resolved_fp:
+            writer = csv.writer(resolved_fp, quotechar='"', delimiter=',')
+            writer.writerow(["title", "author", "year", "goodreads_id"])
+            for book_id in book_ids.tolist():
+                title = get_title(book_id)
+                query = add_typo(title, rng) if rng.random() < typo_rate else title
+                raw_fp.write(query + "\n")
+                queries.setdefault(query, book_id)
+                writer.writerow([title, get_author(book_id), get_year(book_id), book_id])
+                num_picks += 1
+    search_cache = GoodreadsSearchCache(os.path.join(data_dir, "goodreads-cache.db"))
+    num_responses = 0
+    for query, book_id in queries.items():
+        if num_search_responses is not None and num_responses >= num_search_responses:
+            break
+        search_cache.put(query, get_search_response(query, book_id, num_books), commit=False)
+        num_responses += 1
+    search_cache.conn.commit()
+    search_cache.close()
+    for book_id in range(min(num_articles, num_books)):
+        with open(os.path.join(wiki_dir, "synthetic-{}.html".format(book_id)), "w") as fp:
+            fp.write(get_wikipedia_article(get_title(book_id), get_author(book_id), get_year(book_id)))
+    counts = {
+        "people": num_people,
+        "books": num_books,
+        "picks": num_picks,
+        "unique_queries": len(queries),
+        "search_responses": num_responses,
+        "articles": min(num_articles, num_books),
+    }
+    logging.info("Wrote synthetic corpus to %s: %s", data_dir, counts)
+    return counts
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("out_dir", help="The corpus is written to out_dir/data")
+    parser.add_argument("--people", type=int, default=1000)
+    parser.add_argument("--books", type=int, default=10000)
+    parser.add_argument("--picks-per-person", type=int, default=30)
+    parser.add_argument("--typo-rate", type=float, default=0.05)
+    parser.add_argument("--zipf-exponent", type=float, default=1.1,
+                        help="Higher means more overlap between people's picks")
+    parser.add_argument("--search-responses", type=int, default=1000,
+                        help="Number of Goodreads search responses to write. -1 for one per unique query.")
+    parser.add_argument("--articles", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    setup_logging(verbose=False)
+    write_corpus(args.out_dir, args.people, args.books, picks_per_person=args.picks_per_person,
+                 typo_rate=args.typo_rate, zipf_exponent=args.zipf_exponent, seed=args.seed,
+                 num_search_responses=None if args.search_responses < 0 else args.search_responses,
+                 num_articles=args.articles)
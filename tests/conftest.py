@@ -0,0 +1,27 @@
+import csv
+import os
+import sys
+
+import pytest
+
+# the modules in book_classics import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "book_classics"))
+
+# imported after the path is set up
+import dataset  # noqa: E402
+
+
+def write_picks(dirname, person, books, legacy=False):
+    header = ["title", "author", "year"] if legacy else ["title", "author", "year", "goodreads_id"]
+    with open(str(dirname / "{}.csv".format(person.replace(" ", "_"))), "w") as fp:
+        writer = csv.writer(fp)
+        writer.writerow(header)
+        for book_id in books:
+            row = ["T{}".format(book_id), "A{}".format(book_id), str(1900 + book_id)]
+            writer.writerow(row if legacy else row + [str(1000 + book_id)])
+
+
+@pytest.fixture
+def picks_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(dataset, "RESOLVED_PICKS_DIR", str(tmp_path))
+    return tmp_path
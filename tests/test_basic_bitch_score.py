@@ -0,0 +1,47 @@
+import pytest
+
+import dataset
+from basic_bitch_score import ScoringState
+from conftest import write_picks
+
+
+@pytest.fixture
+def state_fname(tmp_path, monkeypatch):
+    fname = str(tmp_path / "scoring-state.dat")
+    monkeypatch.setattr(ScoringState, "FNAME", fname)
+    return fname
+
+
+def get_full_scores(people):
+    state = ScoringState()
+    state.update(dataset.load_dataset(people, cache_fname=None))
+    return state.get_scores()
+
+
+def test_incremental_rescore_matches_full(picks_dir, state_fname):
+    picks = {
+        "Alice": [1, 2, 3],
+        "Bob": [2, 4],
+        "Carol": [4, 5, 6],
+        "Dan": [7],
+    }
+    for person, books in picks.items():
+        write_picks(picks_dir, person, books)
+    people = sorted(picks)
+    state = ScoringState()
+    state.update(dataset.load_dataset(people, cache_fname=None))
+    state.save()
+
+    # Dan now shares a book with Carol, and Bob no longer shares one with Alice
+    write_picks(picks_dir, "Dan", [6, 7])
+    write_picks(picks_dir, "Bob", [4, 8])
+    state = ScoringState.load()
+    rescored = state.update(dataset.load_dataset(people, cache_fname=None))
+    assert rescored == ["Alice", "Bob", "Carol", "Dan"]
+    assert state.get_scores() == get_full_scores(people)
+
+    # nothing changed
+    state.save()
+    state = ScoringState.load()
+    assert state.update(dataset.load_dataset(people, cache_fname=None)) == []
+    assert state.get_scores() == get_full_scores(people)
@@ -0,0 +1,36 @@
+import random
+
+import Levenshtein
+
+from basic_bitch_score import MAX_TITLE_DISTANCE, find_similar_title_pairs
+
+
+def find_similar_title_pairs_all_pairs(all_books):
+    """The O(n^2) scan which find_similar_title_pairs replaced"""
+    pairs = []
+    for i, book1 in enumerate(all_books):
+        for j in range(i + 1, len(all_books)):
+            title1 = book1["title"]
+            title2 = all_books[j]["title"]
+            d = Levenshtein.distance(title1, title2)
+            if d <= MAX_TITLE_DISTANCE and d < 0.5 * min(len(title1), len(title2)):
+                pairs.append((i, j, d))
+    return pairs
+
+
+def test_find_similar_title_pairs_matches_all_pairs():
+    rng = random.Random(0)
+    titles = ["".join(rng.choice("abcde ") for _ in range(rng.randint(3, 14))) for _ in range(300)]
+    # some exact duplicates and near-duplicates
+    titles += titles[:20] + [title[:-1] for title in titles[20:40]]
+    all_books = [{"title": title, "author": "A"} for title in titles]
+    pairs, num_skipped = find_similar_title_pairs(all_books)
+    assert pairs == find_similar_title_pairs_all_pairs(all_books)
+    assert num_skipped > 0
+
+
+def test_find_similar_title_pairs_few_titles():
+    pairs, num_skipped = find_similar_title_pairs([{"title": "abcdef"}, {"title": "abcdeg"}])
+    assert pairs == [(0, 1, 1)]
+    # one comparison to search and one to add, against the one pair
+    assert num_skipped == -1
@@ -0,0 +1,25 @@
+import dataset
+from basic_bitch_score import check_books_unique
+from conftest import write_picks
+
+
+def test_legacy_rows_share_goodreads_id(picks_dir):
+    # the same books, some people resolved before we saved the Goodreads ID
+    picks = {
+        "Alice": ([1, 2, 3], True),
+        "Bob": ([2, 3, 4], False),
+        "Carol": ([4, 5], True),
+        "Dan": ([6, 8], False),
+        "Eve": ([7, 8], True),
+    }
+    for person, (books, legacy) in picks.items():
+        write_picks(picks_dir, person, books, legacy)
+    picks_dataset = dataset.read_dataset(sorted(picks))
+    assert picks_dataset.num_books == 8
+    keys = sorted(picks_dataset.keys.tolist())
+    # books only ever resolved in legacy files keep a legacy ID
+    assert [key for key in keys if key > 0] == [1002, 1003, 1004, 1006, 1008]
+    assert len([key for key in keys if key < 0]) == 3
+    assert check_books_unique(picks_dataset.get_all_books())
+    scores = picks_dataset.get_incidence().basic_bitch_scores()
+    assert scores == {"Alice": 2 / 3, "Bob": 1.0, "Carol": 0.5, "Dan": 0.5, "Eve": 0.5}
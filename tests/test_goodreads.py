@@ -0,0 +1,61 @@
+import csv
+
+import pytest
+
+import goodreads
+from book import GoodreadsBook
+
+
+@pytest.fixture
+def book_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(goodreads, "RESOLVED_PICKS_DIR", str(tmp_path / "resolved-picks"))
+    fname = tmp_path / "bob.txt"
+    fname.write_text("Dune\nNo such book\nEmma\n")
+    return str(fname)
+
+
+def get_book(title, goodreads_id):
+    return GoodreadsBook(title=title, author="Someone", original_publication_year=1900, str_distance=0,
+                         num_ratings=1000, goodreads_id=goodreads_id)
+
+
+def read_rows(fname):
+    with open(fname) as fp:
+        return list(csv.reader(fp))
+
+
+def test_resolved_picks_writer_resumes(book_file):
+    writer = goodreads.ResolvedPicksWriter("Bob", book_file)
+    assert not writer.has_checkpoint()
+    assert writer.open() == 0
+    writer.add(get_book("Dune", 1))
+    writer.add(None)
+    # interrupted
+    writer.close()
+
+    writer = goodreads.ResolvedPicksWriter("Bob", book_file)
+    assert writer.has_checkpoint()
+    assert writer.open() == 2
+    writer.add(get_book("Emma", 2))
+    writer.finish()
+    assert not writer.has_checkpoint()
+    assert read_rows(writer.fname) == [
+        goodreads.RESOLVED_PICKS_HEADER,
+        ["Dune", "Someone", "1900", "1"],
+        ["Emma", "Someone", "1900", "2"],
+    ]
+
+
+def test_resolved_picks_writer_ignores_checkpoint_of_other_picks(book_file):
+    writer = goodreads.ResolvedPicksWriter("Bob", book_file)
+    writer.open()
+    writer.add(get_book("Dune", 1))
+    writer.close()
+    with open(book_file, "a") as fp:
+        fp.write("Ulysses\n")
+
+    writer = goodreads.ResolvedPicksWriter("Bob", book_file)
+    assert not writer.has_checkpoint()
+    assert writer.open() == 0
+    writer.close()
+    assert read_rows(writer.partial_fname) == [goodreads.RESOLVED_PICKS_HEADER]
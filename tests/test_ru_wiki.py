@@ -0,0 +1,75 @@
+import os
+import threading
+
+import pytest
+
+import ru_wiki
+from replay_server import ReplayServer
+from synthetic_corpus import get_wikipedia_article
+
+
+@pytest.fixture
+def wiki_server(tmp_path, monkeypatch):
+    """The replay server standing in for Wikipedia, with two pages"""
+    pages = {
+        "Анна Каренина": ("Лев Толстой", 1877),
+        "Мастер и Маргарита": ("Михаил Булгаков", 1967),
+    }
+    wiki_pages = {}
+    for i, (title, (author, year)) in enumerate(pages.items()):
+        fname = str(tmp_path / "{}.html".format(i))
+        with open(fname, "w", encoding="utf-8") as fp:
+            fp.write(get_wikipedia_article(title, author, year, num_paragraphs=2))
+        wiki_pages[title] = fname
+    server = ReplayServer(("localhost", 0), {}, wiki_pages)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = "http://localhost:{}".format(server.server_address[1])
+    monkeypatch.setattr(ru_wiki, "base_url", base_url + "/w/api.php")
+    monkeypatch.setattr(ru_wiki, "base_url_html", base_url + "/wiki")
+    monkeypatch.setattr(ru_wiki, "WIKI_HTML_CACHE_DIR", str(tmp_path / "wikipedia-cache"))
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_get_books_batch(wiki_server):
+    wiki_cache = ru_wiki.WikiCache()
+    # the first search is normalized by the API, the last doesn't exist
+    searches = ["анна Каренина", "Мастер и Маргарита", "анна Каренина", "Нет такой книги"]
+    books = ru_wiki.get_books(searches, wiki_cache, jobs=2)
+    assert list(books) == ["анна Каренина", "Мастер и Маргарита", "Нет такой книги"]
+    assert books["анна Каренина"].title == "Анна Каренина"
+    assert books["анна Каренина"].author == "Лев Толстой"
+    assert books["Мастер и Маргарита"].original_publication_year == "1967"
+    assert books["Нет такой книги"] is None
+    # a missing page is not cached, so it is looked up again next time
+    assert "Нет такой книги" not in wiki_cache
+    # one query for all the titles, then one request per page found
+    assert wiki_server.stats["requests"] == 3
+    assert len(os.listdir(ru_wiki.WIKI_HTML_CACHE_DIR)) == 2
+
+
+def test_get_page_titles_redirects():
+    data = {"query": {
+        "normalized": [{"from": "анна Каренина", "to": "Анна Каренина"}],
+        "redirects": [{"from": "Анна Каренина", "to": "Анна Каренина (роман)"}],
+        "pages": {
+            "1": {"pageid": 1, "ns": 0, "title": "Анна Каренина (роман)"},
+            "-1": {"ns": 0, "title": "Нет такой книги", "missing": ""},
+            "-2": {"title": "<>", "invalid": "", "invalidreason": "bad title"},
+        },
+    }}
+    titles = ru_wiki.get_page_titles(data, ["анна Каренина", "Нет такой книги", "<>"])
+    assert titles == {"анна Каренина": "Анна Каренина (роман)"}
+
+
+def test_wiki_cache_save_load(wiki_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(ru_wiki.WikiCache, "FNAME", str(tmp_path / "wiki-cache.dat"))
+    wiki_cache = ru_wiki.WikiCache()
+    ru_wiki.get_books(["Мастер и Маргарита"], wiki_cache)
+    wiki_cache.save()
+    assert not os.path.exists(str(tmp_path / "wiki-cache.dat.tmp"))
+    loaded = ru_wiki.WikiCache.load()
+    assert loaded.searches == wiki_cache.searches
+    assert ru_wiki.get_cached_book("Мастер и Маргарита", loaded).author == "Михаил Булгаков"
@@ -0,0 +1,61 @@
+import random
+
+import numpy as np
+import pytest
+
+import similarity
+from incidence import PersonBookIncidence
+
+
+@pytest.fixture
+def incidence():
+    rng = random.Random(0)
+    # a few popular books and many rare ones, with some repeated picks
+    person_to_books = {
+        "p{}".format(i): [min(int(rng.paretovariate(1.0)), 40) for _ in range(rng.randint(1, 8))]
+        for i in range(60)
+    }
+    return PersonBookIncidence.from_person_to_books(person_to_books)
+
+
+def get_brute_force_neighbours(incidence, k, metric):
+    """:return:     list of (person, rank, neighbour, shared) by comparing every pair of people"""
+    picks = [set(incidence.matrix[row].indices.tolist()) for row in range(len(incidence.people))]
+    other_metric = similarity.OVERLAP if metric == similarity.JACCARD else similarity.JACCARD
+
+    def score(a, b, m):
+        shared = len(picks[a] & picks[b])
+        return shared if m == similarity.OVERLAP else shared / len(picks[a] | picks[b])
+
+    neighbours = []
+    for a in range(len(picks)):
+        others = [b for b in range(len(picks)) if b != a and picks[a] & picks[b]]
+        others.sort(key=lambda b: (-score(a, b, metric), -score(a, b, other_metric), b))
+        for rank, b in enumerate(others[:k]):
+            neighbours.append((a, rank + 1, b, len(picks[a] & picks[b])))
+    return neighbours
+
+
+def flatten(chunks):
+    return [(row, rank, col, shared) for chunk in chunks
+            for row, rank, col, shared in zip(chunk.people.tolist(), chunk.ranks.tolist(),
+                                              chunk.neighbours.tolist(), chunk.shared.tolist())]
+
+
+@pytest.mark.parametrize("metric", similarity.METRICS)
+@pytest.mark.parametrize("k", [1, 3])
+def test_exact_matches_brute_force(incidence, metric, k):
+    # a small memory cap, so there are many chunks
+    chunks = similarity.iter_exact_neighbours(incidence, k, metric, max_memory_bytes=4096)
+    assert flatten(chunks) == get_brute_force_neighbours(incidence, k, metric)
+
+
+def test_approximate_is_subset_of_exact(incidence):
+    exact = flatten(similarity.iter_exact_neighbours(incidence, 100, similarity.JACCARD))
+    exact_pairs = set((row, col, shared) for row, _, col, shared in exact)
+    approximate = flatten(similarity.iter_approximate_neighbours(incidence, 5, similarity.JACCARD,
+                                                                 num_hashes=16, rows_per_band=2))
+    assert approximate != []
+    assert set((row, col, shared) for row, _, col, shared in approximate) <= exact_pairs
+    ranks = np.array([rank for _, rank, _, _ in approximate])
+    assert ranks.min() == 1 and ranks.max() <= 5